@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""
+Stand-in for the greatape MailChimp client, for testing without a MailChimp
+account. Use it by setting MAILCHIMP_CLIENT = 'fakemailchimp.FakeMailChimp'
+along with any MAILCHIMP_API_KEY and MAILCHIMP_LIST_ID.
+
+List members are kept in memory and shared by all clients in the process.
+"""
+
+from collections import defaultdict
+from functools import partial
+from threading import Lock
+import time
+
+
+class MailChimpError(Exception):
+    def __init__(self, msg, code):
+        Exception.__init__(self, msg)
+        self.msg = msg
+        self.code = code
+
+
+class FakeMailChimp(object):
+    """
+    Implements the greatape calling convention (``mc.methodName(**params)``)
+    for the list methods this site uses.
+    """
+    #: List id -> email -> merge vars
+    lists = defaultdict(dict)
+    #: (method, params) for every call made
+    calls = []
+    #: Number of upcoming calls that should fail, to test retries
+    failures = 0
+    #: Email addresses that batch subscribes reject, as MailChimp does for
+    #: invalid or banned addresses
+    rejected = set()
+    #: Seconds each call takes, to simulate network latency
+    delay = 0
+    #: Calls in progress, and the most there have been at once
+    active = 0
+    max_active = 0
+    _lock = Lock()
+
+    def __init__(self, api_key, ssl=True, debug=False):
+        self.api_key = api_key
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls.lists.clear()
+            del cls.calls[:]
+            cls.failures = 0
+            cls.rejected.clear()
+            cls.active = cls.max_active = 0
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return partial(self, method=name)
+
+    def __call__(self, **kwargs):
+        method = kwargs.pop('method')
+        with self._lock:
+            FakeMailChimp.active += 1
+            FakeMailChimp.max_active = max(self.max_active, self.active)
+        try:
+            if self.delay:
+                time.sleep(self.delay)
+            return self._dispatch(method, kwargs)
+        finally:
+            with self._lock:
+                FakeMailChimp.active -= 1
+
+    def _dispatch(self, method, kwargs):
+        with self._lock:
+            self.calls.append((method, kwargs))
+            if self.failures:
+                FakeMailChimp.failures -= 1
+                raise MailChimpError("Simulated failure", -98)
+            handler = getattr(self, '_' + method, None)
+            if handler is None:
+                raise MailChimpError("Invalid method: %s" % method, -32601)
+            return handler(**kwargs)
+
+    def _listSubscribe(self, id, email_address, merge_vars=None, update_existing=False, **kwargs):
+        members = self.lists[id]
+        if email_address in members and not update_existing:
+            raise MailChimpError("%s is already subscribed to list" % email_address, 214)
+        members[email_address] = dict(merge_vars or {})
+        return True
+
+    def _listUnsubscribe(self, id, email_address, **kwargs):
+        members = self.lists[id]
+        if email_address not in members:
+            raise MailChimpError("%s is not subscribed to list" % email_address, 215)
+        del members[email_address]
+        return True
+
+    def _listBatchSubscribe(self, id, batch, update_existing=False, **kwargs):
+        members = self.lists[id]
+        result = {'add_count': 0, 'update_count': 0, 'error_count': 0, 'errors': []}
+        for item in batch:
+            item = dict(item)
+            email = item.pop('EMAIL')
+            if email in self.rejected:
+                result['error_count'] += 1
+                result['errors'].append({'code': 502, 'message': "Invalid Email Address: %s" % email,
+                                         'email': email})
+                continue
+            if email in members:
+                if not update_existing:
+                    result['error_count'] += 1
+                    result['errors'].append({'code': 214, 'message': "Already subscribed", 'email': email})
+                    continue
+                result['update_count'] += 1
+            else:
+                result['add_count'] += 1
+            members[email] = item
+        return result
+
+    def _listBatchUnsubscribe(self, id, emails, **kwargs):
+        members = self.lists[id]
+        result = {'success_count': 0, 'error_count': 0, 'errors': []}
+        for email in emails:
+            if members.pop(email, None) is None:
+                result['error_count'] += 1
+                result['errors'].append({'code': 215, 'message': "Not subscribed", 'email': email})
+            else:
+                result['success_count'] += 1
+        return result
+
+    def _listMembers(self, id, **kwargs):
+        return [{'email': email} for email in sorted(self.lists[id])]
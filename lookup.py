@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-memory lookup of participants by email or name for the venue desk. Keys
+are kept in a sorted list for prefix searches, and trigrams of each key are
+indexed for fuzzy matches, so a typo in an email address still finds the
+registration.
+"""
+
+from bisect import bisect_left, insort
+from collections import defaultdict
+from threading import Lock
+import re
+
+_split_words = re.compile(r'[^\w]+', re.UNICODE)
+
+
+def normalize_email(email):
+    """
+    Lower case and strip an email address for comparison.
+    """
+    return (email or '').strip().lower()
+
+
+def email_key(email):
+    """
+    Key for finding duplicate registrations: the email address normalized,
+    with any +tag removed from the part before the @.
+    """
+    email = normalize_email(email)
+    if '@' in email:
+        local, domain = email.rsplit('@', 1)
+        email = '%s@%s' % (local.split('+', 1)[0], domain)
+    return email
+
+
+def name_tokens(fullname):
+    """
+    Lower case words in a name.
+    """
+    return [word for word in _split_words.split((fullname or '').lower()) if word]
+
+
+def local_part(key):
+    """
+    Part of an email address before the @, or the whole of any other key.
+    Fuzzy matching is on this part as it is shared by fewer addresses.
+    """
+    return key.split('@', 1)[0]
+
+
+def trigrams(text):
+    """
+    Set of three-character substrings of a string, padded so that short
+    strings and word starts have trigrams too.
+    """
+    text = '  %s ' % text
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class LookupIndex(object):
+    """
+    Index of participant ids by email address and name words. Exact email
+    matches ignore case and +tags, as :func:`email_key`.
+    Call :meth:`add` for each participant, in any order. Adding an id again
+    does nothing, so callers may rescan rows they might have missed.
+    """
+    #: Fuzzy matches must share at least this fraction of trigrams
+    threshold = 0.4
+
+    def __init__(self):
+        self._seen = set()
+        self._emails = {}
+        self._keys = []
+        self._trigrams = defaultdict(set)
+        self._sizes = {}
+        self._ids = defaultdict(list)
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def add(self, id, email, fullname):
+        email = normalize_email(email)
+        with self._lock:
+            if id in self._seen:
+                return
+            self._seen.add(id)
+            insort(self._emails.setdefault(email_key(email), []), id)
+            for key in [email] + name_tokens(fullname):
+                insort(self._keys, (key, id))
+                if key not in self._ids:
+                    keygrams = trigrams(local_part(key))
+                    self._sizes[key] = len(keygrams)
+                    for trigram in keygrams:
+                        self._trigrams[trigram].add(key)
+                insort(self._ids[key], id)
+
+    def exact(self, email):
+        """
+        Ids of participants with this email address.
+        """
+        return list(self._emails.get(email_key(email), ()))
+
+    def prefix(self, text, limit=10):
+        """
+        Ids of participants whose email address or a word in whose name
+        starts with ``text``, in key order.
+        """
+        text = text.strip().lower()
+        if not text:
+            return []
+        ids = []
+        with self._lock:
+            pos = bisect_left(self._keys, (text,))
+            while pos < len(self._keys) and len(ids) < limit:
+                key, id = self._keys[pos]
+                if not key.startswith(text):
+                    break
+                if id not in ids:
+                    ids.append(id)
+                pos += 1
+        return ids
+
+    def fuzzy(self, text, limit=10):
+        """
+        Ids of participants whose email address or a name word resembles
+        ``text``, best match first. Candidates are found and scored on the
+        part before the @, with the whole address breaking ties.
+        """
+        text = text.strip().lower()
+        if not text:
+            return []
+        wanted = trigrams(local_part(text))
+        whole = trigrams(text)
+        shared = defaultdict(int)
+        scores = {}
+        with self._lock:
+            for trigram in wanted:
+                for key in self._trigrams.get(trigram, ()):
+                    shared[key] += 1
+            for key, count in shared.items():
+                score = float(count) / (len(wanted) + self._sizes[key] - count)
+                if score >= self.threshold:
+                    score = (score, len(whole & trigrams(key)))
+                    for id in self._ids[key]:
+                        if score > scores.get(id, (0, 0)):
+                            scores[id] = score
+        return sorted(scores, key=lambda id: (-scores[id][0], -scores[id][1], id))[:limit]
+
+    def search(self, text, limit=10):
+        """
+        Exact email matches, then prefix matches, then fuzzy matches. Returns
+        (ids, kind) where kind is 'exact', 'prefix', 'fuzzy' or None.
+        """
+        ids = self.exact(text)
+        if ids:
+            return ids[:limit], 'exact'
+        ids = self.prefix(text, limit)
+        if ids:
+            return ids, 'prefix'
+        ids = self.fuzzy(text, limit)
+        if ids:
+            return ids, 'fuzzy'
+        return [], None
@@ -0,0 +1,58 @@
+"""Normalized email for duplicate detection
+
+Revision ID: 1f5b8e2d7a60
+Revises: e4a6d0c93f15
+Create Date: 2026-10-17 17:12:05.640913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import table, column
+
+
+revision = '1f5b8e2d7a60'
+down_revision = 'e4a6d0c93f15'
+branch_labels = None
+depends_on = None
+
+
+participant_table = table('participant',
+    column('id', sa.Integer()),
+    column('email', sa.Unicode(80)),
+    column('email_key', sa.Unicode(80)))
+
+
+def email_key(email):
+    # A copy of lookup.email_key as it was when this migration was written
+    email = (email or '').strip().lower()
+    if '@' in email:
+        local, domain = email.rsplit('@', 1)
+        email = '%s@%s' % (local.split('+', 1)[0], domain)
+    return email
+
+
+def upgrade():
+    op.add_column('participant', sa.Column('email_key', sa.Unicode(length=80), nullable=True))
+    conn = op.get_bind()
+    update = participant_table.update().where(participant_table.c.id == sa.bindparam('pid')).values(
+        email_key=sa.bindparam('key'))
+    last = 0
+    while True:
+        rows = conn.execute(sa.select([participant_table.c.id, participant_table.c.email]).where(
+            participant_table.c.id > last).order_by(participant_table.c.id).limit(1000)).fetchall()
+        if not rows:
+            break
+        conn.execute(update, [{'pid': id, 'key': email_key(email)} for id, email in rows])
+        last = rows[-1][0]
+    # SQLite can't alter a column in place; batch mode copies the table there
+    with op.batch_alter_table('participant') as batch:
+        batch.alter_column('email_key',
+            existing_type=sa.Unicode(length=80),
+            nullable=False)
+    op.create_index('ix_participant_edition_email_key', 'participant', ['edition', 'email_key'])
+
+
+def downgrade():
+    op.drop_index('ix_participant_edition_email_key', table_name='participant')
+    with op.batch_alter_table('participant') as batch:
+        batch.drop_column('email_key')
@@ -0,0 +1,30 @@
+"""Indexes for participant access paths
+
+Revision ID: 3a1c9e5d2f47
+Revises: 7f041b65b4ce
+Create Date: 2026-10-17 10:12:04.318220
+
+"""
+from alembic import op
+
+
+revision = '3a1c9e5d2f47'
+down_revision = '7f041b65b4ce'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_participant_edition_fullname', 'participant', ['edition', 'fullname'])
+    op.create_index('ix_participant_edition_email', 'participant', ['edition', 'email'])
+    op.create_index('ix_participant_edition_approved_rsvp', 'participant', ['edition', 'approved', 'rsvp'])
+    op.create_index('ix_participant_edition_attended', 'participant', ['edition', 'attended'])
+    op.create_index('ix_participant_user_id_edition', 'participant', ['user_id', 'edition'])
+
+
+def downgrade():
+    op.drop_index('ix_participant_user_id_edition', table_name='participant')
+    op.drop_index('ix_participant_edition_attended', table_name='participant')
+    op.drop_index('ix_participant_edition_approved_rsvp', table_name='participant')
+    op.drop_index('ix_participant_edition_email', table_name='participant')
+    op.drop_index('ix_participant_edition_fullname', table_name='participant')
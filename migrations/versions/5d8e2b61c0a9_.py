@@ -0,0 +1,28 @@
+"""Parsed user agent columns for participant
+
+Revision ID: 5d8e2b61c0a9
+Revises: 3a1c9e5d2f47
+Create Date: 2026-10-17 11:40:27.904512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '5d8e2b61c0a9'
+down_revision = '3a1c9e5d2f47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Run `flask backfilluseragents` after upgrading to parse existing rows
+    op.add_column('participant', sa.Column('ua_browser', sa.Unicode(length=40), nullable=True))
+    op.add_column('participant', sa.Column('ua_version', sa.Unicode(length=20), nullable=True))
+    op.add_column('participant', sa.Column('ua_platform', sa.Unicode(length=40), nullable=True))
+
+
+def downgrade():
+    op.drop_column('participant', 'ua_platform')
+    op.drop_column('participant', 'ua_version')
+    op.drop_column('participant', 'ua_browser')
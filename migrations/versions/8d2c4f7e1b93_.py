@@ -0,0 +1,34 @@
+"""MailChimp sync state
+
+Revision ID: 8d2c4f7e1b93
+Revises: 1f5b8e2d7a60
+Create Date: 2026-10-17 18:05:37.102846
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '8d2c4f7e1b93'
+down_revision = '1f5b8e2d7a60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Members subscribed before this table existed are sent again by the first
+    # `flask syncmailchimp`, which then records them here
+    op.create_table('mailchimp_member',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('email', sa.Unicode(length=80), nullable=False),
+        sa.Column('digest', sa.String(length=40), nullable=True),
+        sa.Column('status', sa.Unicode(length=1), nullable=False),
+        sa.Column('last_error', sa.UnicodeText(), nullable=True),
+        sa.Column('updated_date', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('email')
+        )
+
+
+def downgrade():
+    op.drop_table('mailchimp_member')
@@ -0,0 +1,22 @@
+"""Index participant by edition and registration date
+
+Revision ID: 9b4f7a13e6d2
+Revises: 5d8e2b61c0a9
+Create Date: 2026-10-17 13:05:51.627340
+
+"""
+from alembic import op
+
+
+revision = '9b4f7a13e6d2'
+down_revision = '5d8e2b61c0a9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_participant_edition_regdate', 'participant', ['edition', 'regdate'])
+
+
+def downgrade():
+    op.drop_index('ix_participant_edition_regdate', table_name='participant')
@@ -0,0 +1,36 @@
+"""Background job table
+
+Revision ID: c27e5f0a8b34
+Revises: 9b4f7a13e6d2
+Create Date: 2026-10-17 14:21:09.551806
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'c27e5f0a8b34'
+down_revision = '9b4f7a13e6d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('job',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.Unicode(length=40), nullable=False),
+        sa.Column('payload', sa.UnicodeText(), nullable=False),
+        sa.Column('status', sa.Unicode(length=1), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('run_after', sa.DateTime(), nullable=False),
+        sa.Column('last_error', sa.UnicodeText(), nullable=True),
+        sa.Column('created_date', sa.DateTime(), nullable=False),
+        sa.Column('updated_date', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+        )
+    op.create_index('ix_job_status_run_after', 'job', ['status', 'run_after'])
+
+
+def downgrade():
+    op.drop_index('ix_job_status_run_after', table_name='job')
+    op.drop_table('job')
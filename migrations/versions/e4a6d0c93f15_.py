@@ -0,0 +1,33 @@
+"""Attendance change log for venue sign-in sheets
+
+Revision ID: e4a6d0c93f15
+Revises: c27e5f0a8b34
+Create Date: 2026-10-17 16:02:44.318270
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'e4a6d0c93f15'
+down_revision = 'c27e5f0a8b34'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('attendance_log',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('edition', sa.Unicode(length=80), nullable=False),
+        sa.Column('participant_id', sa.Integer(), nullable=False),
+        sa.Column('attended', sa.Boolean(), nullable=False),
+        sa.Column('created_date', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['participant_id'], ['participant.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+    op.create_index('ix_attendance_log_edition_id', 'attendance_log', ['edition', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_attendance_log_edition_id', table_name='attendance_log')
+    op.drop_table('attendance_log')
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+Password hashing in a bounded process pool. Hashes are computed with
+werkzeug's ``generate_password_hash`` and ``check_password_hash`` in a small
+pool of processes, so a burst of logins uses at most ``workers`` CPUs and
+leaves the rest for other pages. The request thread still waits for its own
+hash, but logins beyond the backlog are turned away at once instead of
+queueing.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from threading import Lock, Semaphore
+import multiprocessing
+import os
+import time
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
+
+
+class HasherBusy(Exception):
+    """
+    Raised when too many hashes are waiting for the pool.
+    """
+    pass
+
+
+class PasswordHasher(object):
+    """
+    Hash and verify passwords with ``method`` (as for werkzeug's
+    ``generate_password_hash``) in a pool of ``workers`` processes, with at
+    most ``backlog`` requests waiting. :exc:`HasherBusy` is raised at once
+    if the backlog is full, or if a hash takes longer than ``timeout``
+    seconds. With no workers, hashing is done in the calling thread.
+
+    The pool is started with the forkserver (or spawn) method, as forking a
+    web process would copy its threads' locks in whatever state they were.
+    """
+    def __init__(self, method='pbkdf2:sha256', workers=2, backlog=16, timeout=10):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        # Hashes made with the current method start with this
+        self.prefix = _hash_prefix(method)
+        self.counters = {'hash': 0, 'verify': 0, 'busy': 0, 'timeouts': 0,
+                         'wait_ms': 0.0, 'run_ms': 0.0, 'max_ms': 0.0}
+        self._slots = Semaphore(workers + backlog)
+        self._lock = Lock()
+        self._pool = None
+        self._pid = None
+
+    def _submit(self, kind, func, *args):
+        if not self.workers:
+            start = time.time()
+            result = func(*args)
+            self._record(kind, 0, time.time() - start)
+            return result
+        if not self._slots.acquire(False):
+            with self._lock:
+                self.counters['busy'] += 1
+            raise HasherBusy()
+        try:
+            with self._lock:
+                if self._pid != os.getpid():
+                    # First use, or the pool belongs to the process we were forked from
+                    self._pool = ProcessPoolExecutor(self.workers, mp_context=_pool_context())
+                    self._pid = os.getpid()
+                pool = self._pool
+            start = time.time()
+            future = pool.submit(_timed, func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        # A hash that times out keeps its slot until it finishes
+        future.add_done_callback(lambda future: self._slots.release())
+        try:
+            result, elapsed = future.result(timeout=self.timeout)
+        except FutureTimeout:
+            with self._lock:
+                self.counters['timeouts'] += 1
+            raise HasherBusy()
+        self._record(kind, time.time() - start - elapsed, elapsed)
+        return result
+
+    def _record(self, kind, wait, elapsed):
+        with self._lock:
+            self.counters[kind] += 1
+            self.counters['wait_ms'] += wait * 1000
+            self.counters['run_ms'] += elapsed * 1000
+            self.counters['max_ms'] = max(self.counters['max_ms'], (wait + elapsed) * 1000)
+
+    def hash(self, password):
+        return self._submit('hash', generate_password_hash, password, self.method)
+
+    def verify(self, pw_hash, password):
+        return self._submit('verify', check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """
+        True if ``pw_hash`` was not made with the current method.
+        """
+        return pw_hash.split('$', 1)[0] != self.prefix
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        calls = stats['hash'] + stats['verify']
+        if calls:
+            stats['avg_ms'] = (stats['wait_ms'] + stats['run_ms']) / calls
+        return stats
+
+
+def _hash_prefix(method):
+    """
+    The method as werkzeug records it at the start of a hash, with PBKDF2's
+    default iteration count filled in if ``method`` leaves it out.
+    """
+    if method.startswith('pbkdf2:'):
+        args = method[7:].split(':')
+        iterations = int(args[1]) if len(args) > 1 and args[1] else DEFAULT_PBKDF2_ITERATIONS
+        return 'pbkdf2:%s:%d' % (args[0], iterations)
+    return method
+
+
+def _pool_context():
+    """
+    Multiprocessing context for the pool: forkserver where available.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def _timed(func, *args):
+    """
+    Run ``func`` in a pool process, returning its result and run time.
+    """
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def benchmark(iterations, digest='sha256'):
+    """
+    Seconds taken to hash a password with PBKDF2 and ``iterations``.
+    """
+    start = time.time()
+    generate_password_hash('benchmark', 'pbkdf2:%s:%d' % (digest, iterations))
+    return time.time() - start
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""
+Token bucket rate limits for form submissions, keyed by strings such as
+``login:ip:1.2.3.4``. Each key may make ``rate`` requests per second on
+average, in bursts of up to ``burst``.
+
+:class:`MemoryLimiter` keeps buckets in the process. :class:`SQLiteLimiter`
+keeps them in an SQLite file so that all worker processes on a server share
+the same limits.
+"""
+
+from collections import OrderedDict
+from threading import Lock, local
+import os
+import sqlite3
+import time
+
+
+class MemoryLimiter(object):
+    """
+    Buckets in a dictionary, keeping the ``maxkeys`` most recently used.
+    A key that has been forgotten starts again with a full bucket.
+    """
+    def __init__(self, maxkeys=10000):
+        self.maxkeys = maxkeys
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def allow(self, key, rate, burst):
+        """
+        Take a token from the bucket for ``key``. Returns 0 if there was one,
+        else the seconds until there will be.
+        """
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxkeys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class SQLiteLimiter(object):
+    """
+    Buckets in an SQLite database at ``path``, shared by every process that
+    uses the same file. Buckets idle for an hour are removed now and then.
+    If the database can't be used, such as when it stays locked for longer
+    than ``timeout``, requests are allowed and counted in :attr:`errors`.
+    """
+    def __init__(self, path, timeout=1.0):
+        self.path = path
+        self.timeout = timeout
+        self.errors = 0
+        self._local = local()
+        self._calls = 0
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+        return conn
+
+    def allow(self, key, rate, burst):
+        """
+        Take a token from the bucket for ``key``. Returns 0 if there was one,
+        else the seconds until there will be.
+        """
+        try:
+            return self._allow(key, rate, burst)
+        except (sqlite3.Error, OSError):
+            self.errors += 1
+            return 0
+
+    def _allow(self, key, rate, burst):
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            conn.execute('INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                         (key, tokens, now))
+            self._calls += 1
+            if self._calls % 1000 == 0:
+                conn.execute('DELETE FROM bucket WHERE updated < ?', (now - 3600,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
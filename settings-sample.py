@@ -8,7 +8,11 @@ SQLALCHEMY_DATABASE_URI = 'sqlite:///test.db'
 SECRET_KEY = 'make this something random'
 #: Timezone for displayed datetimes
 TIMEZONE = 'Asia/Calcutta'
-#: Access keys for /admin/reasons/<edition>
+#: Access keys for /admin/reasons/<edition>. Keys in this and the other
+#: ACCESSKEY_* settings may be given as is or hashed, as printed by
+#: `flask hashkey <key>`, in a list or as a single string. Changes to this
+#: file take effect within seconds, without a restart, and sign out sessions
+#: that used a removed key
 ACCESSKEY_REASONS = ['test']
 #: Access keys for /admin/list/<edition>
 ACCESSKEY_LIST = ['test']
@@ -16,6 +20,69 @@ ACCESSKEY_LIST = ['test']
 ACCESSKEY_DATA = ['test']
 #: Access key for /admin/approve/<edition>
 ACCESSKEY_APPROVE = ['test']
+#: Seconds an entered access key is remembered in the visitor's session
+ADMIN_SESSION_TTL = 86400
+#: Cache pages for anonymous visitors: 'memory' (per process),
+#: 'filesystem' (shared by processes, in PAGE_CACHE_DIR) or '' to disable.
+#: Pages are cached for PAGE_CACHE_TTL seconds, and only when requested
+#: from one of PAGE_CACHE_HOSTS (as host or host:port; defaults to
+#: SERVER_NAME). With neither set, pages are not cached
+PAGE_CACHE_BACKEND = 'memory'
+PAGE_CACHE_DIR = ''
+PAGE_CACHE_TTL = 300
+PAGE_CACHE_HOSTS = ['www.doctypehtml5.in']
+#: Let the front server send static files. Either set USE_X_SENDFILE = True
+#: (Apache mod_xsendfile, lighttpd), or set STATIC_ACCEL_REDIRECT to the nginx
+#: internal location that maps to the static folder, such as '/_static/'
+USE_X_SENDFILE = False
+STATIC_ACCEL_REDIRECT = ''
+#: Directory for buffering registrations during submission spikes. If set,
+#: each process syncs registrations to a file here and commits them in
+#: groups of REGISTRATION_SPOOL_BATCH, or every REGISTRATION_SPOOL_INTERVAL
+#: seconds. Registrations the database rejects are kept in rejected.log in
+#: this directory. Leave blank to commit each registration as it comes
+REGISTRATION_SPOOL = ''
+REGISTRATION_SPOOL_BATCH = 100
+REGISTRATION_SPOOL_INTERVAL = 0.2
+#: Rate limits on form submissions, kept in each process ('memory'), in an
+#: SQLite file shared by all processes ('sqlite'), or off (''). The file
+#: defaults to ratelimit.db in the instance folder
+RATE_LIMIT_BACKEND = 'memory'
+RATE_LIMIT_SQLITE = ''
+#: Submissions allowed per minute and in a burst: 'ip' for any form per IP
+#: address, and each form id per IP address and per email address
+RATE_LIMITS = {
+    'ip': (30, 10),
+    'regform': (6, 3),
+    'login': (6, 5),
+    }
+#: Password hashing method, as for werkzeug's generate_password_hash. Run
+#: `flask benchpasswords` to find the PBKDF2 iterations that suit this
+#: server. Passwords hashed another way are rehashed at the next login
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256'
+#: Processes that hash passwords, and how many logins may wait for them.
+#: Logins beyond that are asked to try again at once. 0 workers hashes in
+#: the web process
+PASSWORD_HASH_WORKERS = 2
+PASSWORD_HASH_BACKLOG = 16
+#: Seconds to cache logged in users in each process, to save a query per
+#: request. 0 disables the cache
+USER_CACHE_TTL = 30
+#: Seconds between checks for participants registered by other processes,
+#: for the venue desk's email and name lookup
+LOOKUP_REFRESH_INTERVAL = 5
+#: Seconds a venue sign-in sheet waits for attendance changes before polling
+#: again. Keep this below your web server's request timeout. Each waiting
+#: sheet holds a worker thread, so each process keeps at most
+#: VENUESHEET_LONG_POLLS waiting (keep this well below its thread count) and
+#: tells other sheets to poll again after VENUESHEET_POLL_INTERVAL seconds
+VENUESHEET_POLL_TIMEOUT = 25
+VENUESHEET_LONG_POLLS = 2
+VENUESHEET_POLL_INTERVAL = 5
+#: Seconds to cache the charts at /admin/stats/<edition>
+STATS_CACHE_TTL = 60
+#: Number of distinct user agent strings to keep parsed in memory
+USERAGENT_CACHE_SIZE = 1024
 #: MailChimp API key to sync participant list
 #: If you don't want to use MailChimp, leave this blank
 MAILCHIMP_API_KEY = ''
@@ -23,7 +90,23 @@ MAILCHIMP_API_KEY = ''
 #: The list id can be found in the list's settings
 #: or via the API.
 MAILCHIMP_LIST_ID = ''
-#: Mail settings
+#: Members per MailChimp batch subscribe call
+MAILCHIMP_BATCH_SIZE = 500
+#: MailChimp batch calls to make at once, and the most to make per second
+MAILCHIMP_CONCURRENCY = 2
+MAILCHIMP_RATE = 5
+#: Replacement MailChimp client class, as an import path. For testing,
+#: 'fakemailchimp.FakeMailChimp' records calls instead of sending them
+MAILCHIMP_CLIENT = ''
+#: Background jobs (see `flask worker`): seconds before a running job is
+#: presumed dead, attempts before giving up, and the first retry delay,
+#: which doubles with each attempt
+JOB_TIMEOUT = 600
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY = 30
+#: Mail settings. To test without sending mail, run a local SMTP server
+#: that prints messages, such as `python -m aiosmtpd -n -l localhost:8025`
+#: with MAIL_PORT = 8025
 #: MAIL_FAIL_SILENTLY : default True
 #: MAIL_SERVER : default 'localhost'
 #: MAIL_PORT : default 25
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# website.py reads settings.py when imported, so provide one for the tests
+tempdir = tempfile.mkdtemp(prefix='doctype-tests-')
+settings = types.ModuleType('settings')
+settings.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tempdir, 'test.db')
+settings.SECRET_KEY = 'test'
+settings.TIMEZONE = 'Asia/Calcutta'
+settings.ACCESSKEY_APPROVE = ['test']
+settings.MAIL_SERVER = 'localhost'
+settings.MAIL_SUPPRESS_SEND = False
+settings.MAIL_DEFAULT_SENDER = ('DocType HTML5', 'test@example.com')
+settings.MAILCHIMP_API_KEY = 'fake-us1'
+settings.MAILCHIMP_LIST_ID = 'list1'
+settings.MAILCHIMP_CLIENT = 'fakemailchimp.FakeMailChimp'
+settings.MAILCHIMP_RATE = 1000
+settings.JOB_RETRY_DELAY = 0
+settings.PASSWORD_HASH_WORKERS = 0
+sys.modules.setdefault('settings', settings)
+
+import website  # NOQA
+from fakemailchimp import FakeMailChimp  # NOQA
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(tempdir, ignore_errors=True)
+
+
+@pytest.fixture
+def app():
+    with website.app.app_context():
+        website.db.create_all()
+        FakeMailChimp.reset()
+        yield website.app
+        website.db.session.remove()
+        website.db.drop_all()
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough SMTP for smtplib. Messages to an address in the server's
+    ``stall`` dictionary wait for its event to be set before they are
+    accepted, like a slow mail server.
+    """
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost SMTP stand-in')
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line.decode('ascii').strip()
+            verb = command[:4].upper()
+            if verb in ('HELO', 'EHLO'):
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                address = command.split(':', 1)[1].strip().strip('<>')
+                if address in self.server.refused:
+                    self.reply('550 No such user')
+                else:
+                    recipients.append(address)
+                    self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for line in iter(self.rfile.readline, b''):
+                    if line == b'.\r\n':
+                        break
+                    data.append(line)
+                for address in recipients:
+                    if address in self.server.stall:
+                        self.server.stalled.append(address)
+                        if not self.server.stall[address].wait(10):
+                            self.server.timeouts.append(address)
+                self.server.received.append((recipients, b''.join(data)))
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('250 OK')
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('localhost', 0), SMTPHandler)
+        self.received = []
+        self.refused = set()
+        self.stall = {}
+        self.stalled = []
+        self.timeouts = []
+
+    def recipients(self):
+        return [address for recipients, data in self.received for address in recipients]
+
+
+@pytest.fixture
+def smtp(app):
+    server = SMTPStandIn()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    app.config['MAIL_PORT'] = server.server_address[1]
+    website.mail.init_app(app)
+    yield server
+    for event in server.stall.values():
+        event.set()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def participant(app):
+    """
+    Factory for participants, committed, with optional user accounts.
+    """
+    def make(email, edition='pune', approved=True, user=False, **kwargs):
+        p = website.Participant(fullname=kwargs.pop('fullname', email.split('@')[0].title()), email=email,
+                                edition=edition, company=u'Company', jobtitle=u'Developer', reason=u'Reason',
+                                ipaddr=u'127.0.0.1', approved=approved, **kwargs)
+        if user:
+            p.user = website.User(fullname=p.fullname, email=email)
+        website.db.session.add(p)
+        website.db.session.commit()
+        return p
+    return make
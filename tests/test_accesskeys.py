@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import time
+
+import pytest
+
+from website import AccessKeys, accesskey_digest
+
+
+@pytest.fixture
+def settings(tmpdir):
+    """
+    Write a settings file, giving it a new modification time each time.
+    """
+    path = str(tmpdir.join('settings.py'))
+    written = [time.time() - 100]
+
+    def write(text):
+        with open(path, 'w') as f:
+            f.write(text)
+        written[0] += 1
+        os.utime(path, (written[0], written[0]))
+        return path
+    return write
+
+
+def test_plain_and_hashed_keys():
+    keys = AccessKeys({'ACCESSKEY_LIST': ['plain', 'sha256:' + accesskey_digest('hashed')]})
+    assert keys.grant('ACCESSKEY_LIST', 'plain')
+    assert keys.grant('ACCESSKEY_LIST', 'hashed')
+    assert keys.grant('ACCESSKEY_LIST', 'sha256:' + accesskey_digest('hashed')) is None
+    assert keys.grant('ACCESSKEY_LIST', 'wrong') is None
+    assert keys.grant('ACCESSKEY_DATA', 'plain') is None
+
+
+def test_single_string_is_one_key():
+    keys = AccessKeys({'ACCESSKEY_LIST': 'key'})
+    assert keys.grant('ACCESSKEY_LIST', 'key')
+    assert keys.grant('ACCESSKEY_LIST', 'k') is None
+
+
+def test_other_values_are_ignored_with_a_warning(caplog):
+    with caplog.at_level(logging.WARNING):
+        keys = AccessKeys({'ACCESSKEY_LIST': None, 'ACCESSKEY_DATA': ['key']})
+    assert 'ACCESSKEY_LIST' in caplog.text
+    assert keys.grant('ACCESSKEY_DATA', 'key')
+
+
+def test_grants_expire():
+    keys = AccessKeys({'ACCESSKEY_LIST': ['key']}, ttl=60)
+    grant = keys.grant('ACCESSKEY_LIST', 'key')
+    assert grant[2] > time.time()
+    assert keys.verify('ACCESSKEY_LIST', grant) == grant
+    assert keys.verify('ACCESSKEY_DATA', grant) is None
+    grant[2] = int(time.time()) - 1
+    assert keys.verify('ACCESSKEY_LIST', grant) is None
+    assert keys.verify('ACCESSKEY_LIST', 'not a grant') is None
+
+
+def test_reload_renews_or_revokes_grants(settings):
+    path = settings("ACCESSKEY_LIST = ['old', 'kept']\n")
+    keys = AccessKeys({'ACCESSKEY_LIST': ['old', 'kept']}, path, interval=0)
+    old = keys.grant('ACCESSKEY_LIST', 'old')
+    kept = keys.grant('ACCESSKEY_LIST', 'kept')
+    settings("ACCESSKEY_LIST = ['kept', 'new']\n")
+    assert keys.grant('ACCESSKEY_LIST', 'new')
+    assert keys.verify('ACCESSKEY_LIST', old) is None
+    renewed = keys.verify('ACCESSKEY_LIST', kept)
+    assert renewed[0] == kept[0] and renewed[1] != kept[1] and renewed[2] == kept[2]
+
+
+def test_failed_reload_keeps_old_keys(settings, caplog):
+    path = settings("ACCESSKEY_LIST = ['old']\n")
+    keys = AccessKeys({'ACCESSKEY_LIST': ['old']}, path, interval=0)
+    grant = keys.grant('ACCESSKEY_LIST', 'old')
+    settings("ACCESSKEY_LIST = ['new'\n")
+    assert keys.grant('ACCESSKEY_LIST', 'old')
+    assert keys.verify('ACCESSKEY_LIST', grant) == grant
+    assert 'keeping the old keys' in caplog.text
+    # Fixing the file loads it again
+    settings("ACCESSKEY_LIST = ['new']\n")
+    assert keys.grant('ACCESSKEY_LIST', 'old') is None
+    assert keys.grant('ACCESSKEY_LIST', 'new')
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from website import Job, db, enqueue, mail
+from fakemailchimp import FakeMailChimp
+
+
+def run_worker(app, threads=2):
+    result = app.test_cli_runner().invoke(args=['worker', '--once', '--threads', str(threads), '--poll', '0.1'])
+    assert result.exit_code == 0, result.output
+    db.session.expire_all()
+
+
+def test_approval_notice_is_mailed(app, smtp, participant):
+    ids = [participant(u'p%d@example.com' % i).id for i in range(3)]
+    enqueue('notice.approval', participant_ids=ids)
+    db.session.commit()
+    run_worker(app)
+    assert sorted(smtp.recipients()) == [u'p0@example.com', u'p1@example.com', u'p2@example.com']
+    assert b'Your registration has been approved' in smtp.received[0][1]
+    assert [job.status for job in Job.query] == ['D']
+
+
+def test_refused_recipient_does_not_fail_job(app, smtp, participant):
+    ids = [participant(u'gone@example.com').id, participant(u'here@example.com').id]
+    smtp.refused.add(u'gone@example.com')
+    enqueue('notice.approval', participant_ids=ids)
+    db.session.commit()
+    run_worker(app)
+    assert smtp.recipients() == [u'here@example.com']
+    assert [job.status for job in Job.query] == ['D']
+
+
+def test_stalled_send_does_not_hold_up_queue(app, smtp, participant):
+    emails = [u'slow@example.com', u'a@example.com', u'b@example.com', u'c@example.com']
+    for email in emails:
+        enqueue('notice.approval', participant_ids=[participant(email).id])
+    db.session.commit()
+    stall = smtp.stall[u'slow@example.com'] = threading.Event()
+
+    def release():
+        # The slow server answers once everyone else has their mail
+        deadline = time.time() + 10
+        while len(smtp.received) < 3 and time.time() < deadline:
+            time.sleep(0.05)
+        stall.set()
+    threading.Thread(target=release).start()
+
+    run_worker(app, threads=2)
+    assert smtp.recipients() == [u'a@example.com', u'b@example.com', u'c@example.com', u'slow@example.com']
+    assert smtp.timeouts == []
+    assert {job.status for job in Job.query} == {'D'}
+
+
+def test_failed_job_is_retried(app, participant):
+    # No SMTP server is listening, so every attempt fails
+    app.config['MAIL_PORT'] = 1
+    mail.init_app(app)
+    p = participant(u'p@example.com')
+    enqueue('notice.approval', participant_ids=[p.id])
+    db.session.commit()
+    app.config['JOB_MAX_ATTEMPTS'] = 2
+    try:
+        run_worker(app)
+    finally:
+        del app.config['JOB_MAX_ATTEMPTS']
+    job = Job.query.one()
+    assert job.status == 'F'
+    assert job.attempts == 2
+    assert job.last_error
+
+
+def test_mailchimp_subscribe_job(app, participant):
+    p = participant(u'p@example.com', user=True)
+    participant(u'q@example.com', approved=False, user=True)
+    enqueue('mailchimp.subscribe', participant_ids=[p.id])
+    db.session.commit()
+    run_worker(app)
+    assert list(FakeMailChimp.lists['list1']) == [u'p@example.com']
+    assert [job.status for job in Job.query] == ['D']
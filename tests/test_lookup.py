@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from lookup import LookupIndex, email_key
+from website import ParticipantLookup, db
+
+
+def make_index():
+    index = LookupIndex()
+    index.add(1, u'Alice.Smith@Example.com', u'Alice Smith')
+    index.add(2, u'bob+events@example.com', u'Bob Jones')
+    index.add(3, u'alan@example.org', u'Alan Smithers')
+    return index
+
+
+def test_email_key():
+    assert email_key(u'  Alice@Example.COM ') == u'alice@example.com'
+    assert email_key(u'alice+talks@example.com') == u'alice@example.com'
+    assert email_key(u'a+b+c@example.com') == u'a@example.com'
+    assert email_key(u'not an email') == u'not an email'
+    assert email_key(None) == u''
+
+
+def test_exact_match_ignores_case_and_tags():
+    index = make_index()
+    assert index.search(u'alice.smith@example.com') == ([1], 'exact')
+    assert index.search(u'BOB@example.com') == ([2], 'exact')
+    assert index.search(u'bob+other@example.com') == ([2], 'exact')
+
+
+def test_prefix_matches_email_and_name_words():
+    index = make_index()
+    assert index.search(u'al') == ([3, 1], 'prefix')  # alan before alice
+    assert index.search(u'smith') == ([1, 3], 'prefix')
+    assert index.search(u'Jon') == ([2], 'prefix')
+    assert index.prefix(u'al', limit=1) == [3]
+
+
+def test_fuzzy_matches_typos():
+    index = make_index()
+    ids, kind = index.search(u'alice.smiht@example.com')
+    assert kind == 'fuzzy' and ids[0] == 1
+    assert index.search(u'zzzzzz') == ([], None)
+
+
+def test_adding_again_does_nothing():
+    index = make_index()
+    index.add(1, u'alice.smith@example.com', u'Alice Smith')
+    index.add(4, u'alice.smith@example.com', u'Alice Smith')
+    assert len(index) == 4
+    assert index.exact(u'alice.smith@example.com') == [1, 4]
+    assert index.prefix(u'alice') == [1, 4]
+
+
+def test_participants_registered_elsewhere_are_found(app, participant):
+    lookup = ParticipantLookup(refresh=0)
+    participant(u'first@example.com')
+    db.session.commit()
+    assert lookup.search('pune', u'first@example.com')[1] == 'exact'
+    later = participant(u'later@example.com')
+    db.session.commit()
+    assert lookup.search('pune', u'later@example.com') == ([later.id], 'exact')
+    assert lookup.search('bangalore', u'later@example.com') == ([], None)
+    assert lookup.stats()['participants'] == {'pune': 2, 'bangalore': 0}
+
+
+def test_one_thread_scans_per_interval(app, participant):
+    participant(u'first@example.com')
+    db.session.commit()
+    lookup = ParticipantLookup(refresh=0)
+    lookup.search('pune', u'first@example.com')
+    scans = []
+    entered = threading.Event()
+    release = threading.Event()
+
+    def query(edition, after):
+        scans.append(after)
+        entered.set()
+        release.wait(5)
+        return ParticipantLookup.query(lookup, edition, after)
+    lookup.query = query
+
+    def search():
+        with app.app_context():
+            lookup.search('pune', u'first@example.com')
+    scanner = threading.Thread(target=search)
+    scanner.start()
+    assert entered.wait(5)
+    # Searches during the scan use the index as it is
+    assert lookup.search('pune', u'first@example.com')[1] == 'exact'
+    release.set()
+    scanner.join()
+    assert len(scans) == 1
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from website import MailChimpMember, MailChimpSyncError, db, mailchimp, mailchimp_sync
+from fakemailchimp import FakeMailChimp
+
+
+@pytest.fixture
+def members(app, participant, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAILCHIMP_BATCH_SIZE', 2)
+    people = [participant(u'p%d@example.com' % i, user=True) for i in range(5)]
+    participant(u'waiting@example.com', approved=False, user=True)
+    participant(u'nouser@example.com')
+    return people
+
+
+def calls(method):
+    return [params for name, params in FakeMailChimp.calls if name == method]
+
+
+def status():
+    return {m.email: m.status for m in MailChimpMember.query}
+
+
+def test_sync_subscribes_in_batches(members):
+    counts = mailchimp_sync(mailchimp())
+    assert counts == {'subscribed': 5, 'unsubscribed': 0, 'errors': 0, 'unchanged': 0}
+    assert sorted(len(params['batch']) for params in calls('listBatchSubscribe')) == [1, 2, 2]
+    assert sorted(FakeMailChimp.lists['list1']) == [u'p%d@example.com' % i for i in range(5)]
+    assert FakeMailChimp.lists['list1'][u'p0@example.com']['GROUPINGS']['Editions']['groups'] == u'pune'
+    assert set(status().values()) == {'S'}
+
+
+def test_sync_sends_only_changes(members):
+    mailchimp_sync(mailchimp())
+    FakeMailChimp.reset()
+    assert mailchimp_sync(mailchimp())['unchanged'] == 5
+    assert FakeMailChimp.calls == []
+
+    members[1].company = u'New Company'
+    members[2].approved = False
+    db.session.commit()
+    counts = mailchimp_sync(mailchimp())
+    assert counts == {'subscribed': 1, 'unsubscribed': 1, 'errors': 0, 'unchanged': 3}
+    assert [[m['EMAIL'] for m in params['batch']] for params in calls('listBatchSubscribe')] == [
+        [u'p1@example.com']]
+    assert [params['emails'] for params in calls('listBatchUnsubscribe')] == [[u'p2@example.com']]
+    assert status()[u'p2@example.com'] == 'U'
+
+
+def test_sync_records_member_errors(members):
+    FakeMailChimp.rejected.add(u'p3@example.com')
+    counts = mailchimp_sync(mailchimp())
+    assert counts['errors'] == 1
+    member = MailChimpMember.query.filter_by(email=u'p3@example.com').one()
+    assert member.status == 'E'
+    assert u'Invalid Email Address' in member.last_error
+    assert status()[u'p4@example.com'] == 'S'
+
+    # Members in error are sent again on the next sync
+    FakeMailChimp.rejected.clear()
+    FakeMailChimp.reset()
+    assert mailchimp_sync(mailchimp())['subscribed'] == 1
+    assert status()[u'p3@example.com'] == 'S'
+
+
+def test_failed_batch_raises_after_saving_state(app, members, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAILCHIMP_CONCURRENCY', 1)
+    FakeMailChimp.failures = 1
+    with pytest.raises(MailChimpSyncError):
+        mailchimp_sync(mailchimp())
+    assert sorted(status().values()) == ['E', 'E', 'S', 'S', 'S']
+    assert mailchimp_sync(mailchimp())['subscribed'] == 2
+
+
+def test_sync_for_emails_unsubscribes_unknown(members):
+    counts = mailchimp_sync(mailchimp(), [u'p0@example.com', u'waiting@example.com'])
+    assert counts == {'subscribed': 1, 'unsubscribed': 1, 'errors': 0, 'unchanged': 0}
+    assert list(FakeMailChimp.lists['list1']) == [u'p0@example.com']
+    assert status() == {u'p0@example.com': 'S', u'waiting@example.com': 'U'}
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+from werkzeug.datastructures import MultiDict
+from werkzeug.security import generate_password_hash
+
+from passwords import HasherBusy, PasswordHasher
+from website import LoginForm, db, password_hasher
+
+
+@pytest.fixture
+def pooled():
+    hashers = []
+
+    def make(**kwargs):
+        hashers.append(PasswordHasher('pbkdf2:sha256:1000', **kwargs))
+        return hashers[-1]
+    yield make
+    for hasher in hashers:
+        if hasher._pool is not None:
+            hasher._pool.shutdown()
+
+
+def test_hash_and_verify():
+    hasher = PasswordHasher('pbkdf2:sha256:1000', workers=0)
+    pw_hash = hasher.hash('secret')
+    assert pw_hash.startswith('pbkdf2:sha256:1000$')
+    assert hasher.verify(pw_hash, 'secret')
+    assert not hasher.verify(pw_hash, 'wrong')
+    assert hasher.stats()['hash'] == 1 and hasher.stats()['verify'] == 2
+
+
+@pytest.mark.parametrize('method', ['pbkdf2:sha256', 'pbkdf2:sha1:2000', 'sha256'])
+def test_needs_rehash(method):
+    hasher = PasswordHasher(method, workers=0)
+    assert hasher.prefix == generate_password_hash('', method).split('$', 1)[0]
+    assert not hasher.needs_rehash(generate_password_hash('secret', method))
+    assert hasher.needs_rehash(generate_password_hash('secret', 'pbkdf2:sha256:1000'))
+
+
+def test_pool_hashes(pooled):
+    hasher = pooled(workers=1)
+    assert hasher.verify(hasher.hash('secret'), 'secret')
+    assert hasher.stats()['hash'] == 1
+
+
+def test_busy_when_backlog_is_full(pooled):
+    hasher = pooled(workers=1, backlog=0)
+    slow = threading.Thread(target=hasher._submit, args=('hash', time.sleep, 0.5))
+    slow.start()
+    deadline = time.time() + 5
+    while hasher._slots._value:  # Until the slow hash has the only slot
+        assert time.time() < deadline
+        time.sleep(0.01)
+    with pytest.raises(HasherBusy):
+        hasher.hash('secret')
+    slow.join()
+    assert hasher.stats()['busy'] == 1
+
+
+def test_busy_on_timeout(pooled):
+    hasher = pooled(workers=1, timeout=0.1)
+    with pytest.raises(HasherBusy):
+        hasher._submit('hash', time.sleep, 1)
+    assert hasher.stats()['timeouts'] == 1
+
+
+def login(email, password):
+    form = LoginForm(MultiDict([('email', email), ('password', password)]))
+    return form, form.validate()
+
+
+def test_login_rehashes_old_passwords(app, participant):
+    user = participant(u'a@example.com', user=True).user
+    user.pw_hash = generate_password_hash('secret', 'pbkdf2:sha256:1000')
+    form, valid = login(u'a@example.com', 'secret')
+    assert valid and form.user is user
+    assert not password_hasher.needs_rehash(user.pw_hash)
+    assert user.check_password('secret')
+
+
+def test_login_skips_rehash_when_busy(app, participant, monkeypatch):
+    user = participant(u'a@example.com', user=True).user
+    user.pw_hash = old = generate_password_hash('secret', 'pbkdf2:sha256:1000')
+    db.session.commit()
+
+    def busy(password):
+        raise HasherBusy()
+    monkeypatch.setattr(password_hasher, 'hash', busy)
+    form, valid = login(u'a@example.com', 'secret')
+    assert valid and form.user is user
+    assert user.pw_hash == old
+
+
+def test_login_turned_away_when_busy(app, participant, monkeypatch):
+    user = participant(u'a@example.com', user=True).user
+    user.pw_hash = generate_password_hash('secret', 'pbkdf2:sha256:1000')
+
+    def busy(pw_hash, password):
+        raise HasherBusy()
+    monkeypatch.setattr(password_hasher, 'verify', busy)
+    form, valid = login(u'a@example.com', 'secret')
+    assert not valid
+    assert 'busy' in form.password.errors[0]
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+
+import pytest
+from flask_migrate import downgrade, stamp, upgrade
+
+from website import admin_queries, db, fullscan, participant_page_query, query_plan
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+
+@pytest.fixture
+def migrated(app):
+    """
+    A schema whose indexes are made by the migrations. The first migration
+    alters tables that predate migrations, so start from the models, go
+    back down to it and upgrade again.
+    """
+    pytest.importorskip('progressbar')  # Imported by the first migration
+    # Alembic's logging setup disables the loggers it doesn't know about
+    disabled = {name: logger.disabled for name, logger in logging.Logger.manager.loggerDict.items()
+                if isinstance(logger, logging.Logger)}
+    try:
+        stamp(MIGRATIONS, 'head')
+        downgrade(MIGRATIONS, '7f041b65b4ce')
+        upgrade(MIGRATIONS)
+    finally:
+        for name, value in disabled.items():
+            logging.getLogger(name).disabled = value
+    yield
+    db.session.remove()
+    db.session.execute('DROP TABLE alembic_version')
+
+
+def test_admin_queries_use_indexes(migrated):
+    for route, query in admin_queries('pune'):
+        plan = query_plan(query)
+        assert not any(fullscan.match(line) for line in plan), (route, plan)
+
+
+def test_later_pages_use_indexes(migrated, participant):
+    after = participant(u'a@example.com', fullname=u'Anita').id
+    for sort in ('name', '-name', 'regdate', '-regdate'):
+        plan = query_plan(participant_page_query('pune', sort=sort, after=after, search=u'an'))
+        assert not any(fullscan.match(line) for line in plan), (sort, plan)
+
+
+def test_checkplans_command(app, migrated):
+    result = app.test_cli_runner().invoke(args=['checkplans', '--edition', 'pune'])
+    assert result.exit_code == 0, result.output
+    assert 'full table scan' not in result.output
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import sqlite3
+
+import pytest
+
+import ratelimit
+from ratelimit import MemoryLimiter, SQLiteLimiter
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, 'time', clock)
+    return clock
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def limiter(request, tmpdir):
+    if request.param == 'memory':
+        return MemoryLimiter()
+    return SQLiteLimiter(str(tmpdir.join('ratelimit.db')))
+
+
+def test_burst_then_refill(limiter, clock):
+    assert [limiter.allow('k', 1, 3) for i in range(3)] == [0, 0, 0]
+    assert limiter.allow('k', 1, 3) == pytest.approx(1)
+    clock.now += 0.5
+    assert limiter.allow('k', 1, 3) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert limiter.allow('k', 1, 3) == 0
+    # The bucket fills up to the burst size and no further
+    clock.now += 60
+    assert [limiter.allow('k', 1, 3) for i in range(4)][-1] > 0
+    assert limiter.allow('other', 1, 3) == 0
+
+
+def test_memory_limiter_forgets_least_recently_used(clock):
+    limiter = MemoryLimiter(maxkeys=2)
+    for key in ('a', 'b'):
+        limiter.allow(key, 1, 1)
+    limiter.allow('a', 1, 1)
+    limiter.allow('c', 1, 1)
+    assert list(limiter._buckets) == ['a', 'c']
+    # Forgotten keys start again with a full bucket
+    assert limiter.allow('b', 1, 1) == 0
+    assert limiter.allow('c', 1, 1) > 0
+
+
+def test_sqlite_limiter_is_shared(tmpdir, clock):
+    path = str(tmpdir.join('ratelimit.db'))
+    assert SQLiteLimiter(path).allow('k', 1, 1) == 0
+    assert SQLiteLimiter(path).allow('k', 1, 1) > 0
+
+
+def test_sqlite_limiter_allows_when_locked(tmpdir):
+    path = str(tmpdir.join('ratelimit.db'))
+    limiter = SQLiteLimiter(path, timeout=0.05)
+    limiter.allow('k', 1, 1)
+    blocker = sqlite3.connect(path, isolation_level=None)
+    blocker.execute('BEGIN EXCLUSIVE')
+    try:
+        assert limiter.allow('k', 1, 1) == 0
+        assert limiter.errors == 1
+    finally:
+        blocker.execute('ROLLBACK')
+        blocker.close()
+
+
+def test_sqlite_limiter_allows_when_unusable(tmpdir):
+    tmpdir.join('file').write('')
+    limiter = SQLiteLimiter(str(tmpdir.join('file', 'ratelimit.db')))
+    assert limiter.allow('k', 1, 1) == 0
+    assert limiter.allow('k', 1, 1) == 0
+    assert limiter.errors == 2
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+import json
+import os
+import time
+
+from website import Participant, RegistrationSpool, duplicate_clusters, email_key
+
+
+def registration(email, **fields):
+    record = {'fullname': u'Name', 'email': email, 'edition': u'pune', 'company': u'Company',
+              'jobtitle': u'Developer', 'twitter': u'', 'tshirtsize': u'1', 'referrer': u'1',
+              'reason': u'Reason', 'email_key': email_key(email), 'ipaddr': u'127.0.0.1', 'useragent': None,
+              'regdate': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')}
+    record.update(fields)
+    return record
+
+
+def emails():
+    return sorted(p.email for p in Participant.query)
+
+
+def test_spool_writes_registrations(app, tmpdir):
+    spool = RegistrationSpool(str(tmpdir), interval=60)
+    spool.append(registration(u'a@example.com'))
+    spool.append(registration(u'b@example.com'))
+    spool.close()
+    assert emails() == [u'a@example.com', u'b@example.com']
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_repeat_submission_is_kept_for_review(app, tmpdir):
+    spool = RegistrationSpool(str(tmpdir), interval=60)
+    spool.append(registration(u'a@example.com'))
+    spool.append(registration(u'A+again@example.com', company=u'Corrected'))
+    spool.close()
+    assert emails() == [u'A+again@example.com', u'a@example.com']
+    [(key, participants)] = duplicate_clusters(u'pune')
+    assert key == u'a@example.com' and len(participants) == 2
+
+
+def test_replayed_registration_is_written_once(app, tmpdir):
+    data = b''.join(json.dumps(registration(email)).encode('utf-8') + b'\n'
+                    for email in (u'a@example.com', u'b@example.com'))
+    spool = RegistrationSpool(str(tmpdir), interval=60)
+    # As if the process died after committing but before emptying its file
+    assert spool.replay(data) == 2
+    assert spool.replay(data + data) == 0
+    spool.close()
+    assert emails() == [u'a@example.com', u'b@example.com']
+
+
+def test_bad_row_is_set_aside(app, tmpdir):
+    spool = RegistrationSpool(str(tmpdir), interval=60)
+    spool.append(registration(u'a@example.com'))
+    spool.append(registration(u'bad@example.com', company=None))
+    spool.append(registration(u'c@example.com'))
+    spool.close()
+    assert emails() == [u'a@example.com', u'c@example.com']
+    with open(str(tmpdir.join('rejected.log'))) as rejected:
+        assert [json.loads(line)['email'] for line in rejected] == [u'bad@example.com']
+    assert spool.stats()['rejected'] == 1
+
+
+def test_file_of_dead_process_with_same_pid_is_replayed(app, tmpdir):
+    # Left by an earlier process that had the pid we have now
+    with open(str(tmpdir.join('%d.jsonl' % os.getpid())), 'w') as spoolfile:
+        spoolfile.write(json.dumps(registration(u'old@example.com')) + '\n')
+    spool = RegistrationSpool(str(tmpdir), interval=60)
+    spool.append(registration(u'new@example.com'))
+    spool.close()
+    deadline = time.time() + 5
+    while os.listdir(str(tmpdir)) and time.time() < deadline:
+        time.sleep(0.05)
+    assert emails() == [u'new@example.com', u'old@example.com']
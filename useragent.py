@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""
+User agent classification for registrations and statistics. Most visitors
+share a small set of user agent strings, so parsed results are memoized in a
+bounded LRU cache keyed by the raw string.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from werkzeug.useragents import UserAgent
+
+#: Length of Participant.useragent
+MAX_LENGTH = 250
+
+
+def normalize(useragent):
+    """
+    Normalize a user agent string for storage: strip surrounding whitespace
+    and truncate to the column length. Returns None for a blank string.
+    """
+    if useragent is None:
+        return None
+    useragent = ' '.join(useragent.split())[:MAX_LENGTH]
+    return useragent or None
+
+
+class UAClass(object):
+    """
+    Browser, major version and platform for a user agent. Any of these may
+    be None if the user agent could not be identified.
+    """
+    __slots__ = ('browser', 'version', 'platform')
+
+    def __init__(self, browser, version, platform):
+        self.browser = browser
+        self.version = version
+        self.platform = platform
+
+    def __iter__(self):
+        return iter((self.browser, self.version, self.platform))
+
+    def __repr__(self):
+        return '<UAClass %s %s %s>' % (self.browser, self.version, self.platform)
+
+
+class UAClassifier(object):
+    """
+    Memoizing user agent classifier. Holds at most ``maxsize`` results,
+    discarding the least recently used, and counts cache hits and misses.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    def classify(self, useragent):
+        with self._lock:
+            result = self._cache.get(useragent)
+            if result is not None:
+                self._cache.move_to_end(useragent)
+                self.hits += 1
+                return result
+            self.misses += 1
+        result = self._parse(useragent)
+        with self._lock:
+            self._cache[useragent] = result
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return result
+
+    def _parse(self, useragent):
+        ua = UserAgent(useragent)
+        if ua.version:
+            version = ua.version.split('.')[0]
+        else:
+            version = None
+        return UAClass(ua.browser, version, ua.platform)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._cache), 'maxsize': self.maxsize}
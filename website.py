@@ -6,30 +6,76 @@ Website server for doctypehtml5.in
 """
 
 
-from collections import defaultdict
-from datetime import datetime
+from collections import defaultdict, OrderedDict
+from functools import wraps
+import gzip
+import hashlib
+import os
+import csv
+import fcntl
+import glob
+from io import BytesIO, StringIO
+import json
+import mimetypes
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from threading import BoundedSemaphore, Condition, Event, Lock, Thread
+import atexit
+import time
 from flask_migrate import Migrate
 import re
-from flask import Flask, abort, request, render_template, redirect, url_for
-from flask import flash, session, g, Response
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.useragents import UserAgent
+import smtplib
+import sys
+import tempfile
+from flask import Config, Flask, abort, request, render_template, redirect, url_for
+from flask import flash, session, g, Response, jsonify, stream_with_context, send_file, safe_join
+from werkzeug.http import is_resource_modified
+from werkzeug.utils import import_string
+from markupsafe import Markup, escape
 from flask_mail import Mail, Message
 from wtforms import Form, TextField, TextAreaField, PasswordField, SelectField
 from wtforms.validators import DataRequired, Email, ValidationError
 from pytz import utc, timezone
 from markdown import markdown
+import click
 import pygooglechart
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import make_transient_to_detached, validates
+from sqlalchemy.orm.util import identity_key
 from coaster.sqlalchemy import UuidMixin
 import coaster.app
 from coaster.db import db
 from coaster.utils import buid
+from useragent import UAClassifier, normalize as normalize_useragent
+from lookup import LookupIndex, email_key
+from ratelimit import MemoryLimiter, SQLiteLimiter
+from passwords import PasswordHasher, HasherBusy, benchmark as benchmark_password_hash
 
 try:
-    from greatape import MailChimp, MailChimpError
+    from greatape import MailChimp
 except ImportError:
     MailChimp = None
 
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image, features as image_features
+except ImportError:
+    Image = None
+
 app = Flask(__name__)
 mail = Mail()
 
@@ -99,18 +145,104 @@ GALLERY_SECTIONS = [
 
 hideemail = re.compile('.{1,3}@')
 
+#: Static files worth precompressing (see the ``compressstatic`` command)
+COMPRESSIBLE_STATIC = ('.css', '.js', '.ics', '.svg', '.eps', '.ps', '.txt', '.xml', '.ico')
+
+#: Widths of resized image variants (see the ``buildimages`` command). An
+#: image is only resized to widths smaller than its own
+IMAGE_WIDTHS = (70, 140, 280, 640, 1280)
+
+#: Static asset bundles, built by the ``buildassets`` command. Bundle name ->
+#: list of (file, media). Bundles are written next to their source files
+#: so that relative URLs in stylesheets still work.
+ASSET_BUNDLES = {
+    'css/bundle.css': [
+        ('css/style.css', None),
+        ('css/jquery-ui.css', 'screen, projector'),
+        ('css/site.css', None),
+        ],
+    'js/bundle.js': [
+        ('js/jquery-ui-1.8.4.min.js', None),
+        ('js/sammy-0.5.4.min.js', None),
+        ('js/jquery.form.js', None),
+        ],
+    }
+
+#: Sort orders for paginated participant tables: name in URL -> column
+TABLE_SORTS = {
+    'name': 'fullname',
+    'regdate': 'regdate',
+    }
+
+#: Form submissions allowed per minute and burst size: any form per IP
+#: address, and each form per IP address and per email address
+DEFAULT_RATE_LIMITS = {
+    'ip': (30, 10),
+    'regform': (6, 3),
+    'login': (6, 5),
+    }
+
 
 # -------------------------------------------------------------------------
 # Utility functions
 
 def currentuser():
     """
-    Get the current user, or None if user isn't logged in.
+    Get the current user, or None if user isn't logged in. The user is looked
+    up once per request.
     """
-    if 'userid' in session and session['userid']:
-        return User.query.filter_by(email=session['userid']).first()
-    else:
-        return None
+    if '_currentuser' not in g:
+        user = None
+        if session.get('user_id'):
+            user = loaduser(session['user_id'])
+        elif session.get('userid'):
+            # Sessions from before user ids were stored have the email address
+            user = User.query.filter_by(email=session['userid']).first()
+            if user is not None:
+                login(user)
+        g._currentuser = user
+    return g._currentuser
+
+
+def loaduser(user_id):
+    """
+    Get a user by id. Looks in the database session's identity map, then the
+    process-wide user cache, and only then queries the database.
+    """
+    user = db.session.identity_map.get(identity_key(User, user_id))
+    if user is not None:
+        return user
+    values = user_cache.get(user_id)
+    if values is not None:
+        user = User()
+        for key, value in values.items():
+            setattr(user, key, value)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+    user = User.query.get(user_id)
+    if user is not None and user_cache.ttl:
+        user_cache.set(user_id, {column.key: getattr(user, column.key) for column in User.__table__.columns})
+    return user
+
+
+def login(user):
+    """
+    Remember the user in the session.
+    """
+    g.user = g._currentuser = user
+    session.pop('userid', None)
+    session['user_id'] = user.id
+
+
+def logout_user():
+    """
+    Forget the session's user.
+    """
+    if session.get('user_id'):
+        user_cache.delete(session['user_id'])
+    g.user = g._currentuser = None
+    session.pop('userid', None)
+    session.pop('user_id', None)
 
 
 def getuser(f):
@@ -124,6 +256,678 @@ def getuser(f):
     return wrapped
 
 
+def localtime_formatter(tz, format):
+    """
+    Return a function that formats naive UTC datetimes in timezone ``tz``.
+    The UTC offset is looked up once per hour of UTC time instead of once
+    per datetime, which matters when formatting thousands of rows.
+    """
+    offsets = {}
+
+    def formatter(dt):
+        hour = dt.replace(minute=0, second=0, microsecond=0)
+        offset = offsets.get(hour)
+        if offset is None:
+            offset = offsets[hour] = utc.localize(hour).astimezone(tz).utcoffset()
+        return (dt + offset).strftime(format)
+    return formatter
+
+
+def chunked(items, size):
+    """
+    Yield successive lists of up to ``size`` items.
+    """
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+#: Named callables that return counters for /admin/metrics
+metrics = {}
+
+
+def register_metrics(name, provider):
+    """
+    Expose the dictionary returned by ``provider`` at /admin/metrics.
+    """
+    metrics[name] = provider
+
+
+class TTLCache(object):
+    """
+    A small thread-safe in-process cache whose entries expire after ``ttl``
+    seconds. Each worker process has its own copy.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._data = {}
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] < time.time():
+                del self._data[key]
+                return default
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class TokenBucket(object):
+    """
+    Thread-safe rate limiter allowing ``rate`` operations per second on
+    average, in bursts of up to ``burst``.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available.
+        """
+        while True:
+            with self._lock:
+                self._refill(time.time())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def accesskey_digest(key):
+    """
+    Digest of an access key, as stored by :class:`AccessKeys`. Settings may
+    give keys in this form, prefixed with ``sha256:``.
+    """
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class AccessKeys(object):
+    """
+    Admin access keys from the ACCESSKEY_* settings, held as sets of SHA-256
+    digests so that checking a key is one hash and one set lookup, and the
+    lookup's timing depends only on the digest. Keys in settings may be
+    plain or ``sha256:<digest>`` (see ``flask hashkey``).
+
+    If ``path`` is given, it is checked at most every ``interval`` seconds
+    and the keys are reloaded when it changes, so keys can be rotated
+    without a restart. If the changed file can't be loaded, the old keys
+    are kept until it changes again.
+    """
+    def __init__(self, config, path=None, interval=5, ttl=86400):
+        self.path = path
+        self.interval = interval
+        self.ttl = ttl
+        self._mtime = os.path.getmtime(path) if path else None
+        self._checked = time.time()
+        self._lock = Lock()
+        self.load(config)
+
+    def load(self, config):
+        keys = {}
+        fingerprints = {}
+        for name, value in config.items():
+            if not name.startswith('ACCESSKEY_'):
+                continue
+            if isinstance(value, str):
+                value = [value]  # A single key
+            elif not isinstance(value, (list, tuple, set, frozenset)):
+                app.logger.warning("Ignoring %s: expected a list of access keys, not %s", name, type(value).__name__)
+                continue
+            digests = frozenset(key[7:] if key.startswith('sha256:') else accesskey_digest(key)
+                                for key in value)
+            keys[name] = digests
+            fingerprints[name] = hashlib.sha256(' '.join(sorted(digests)).encode('ascii')).hexdigest()[:16]
+        self._keys, self._fingerprints = keys, fingerprints
+
+    def refresh(self):
+        """
+        Reload keys if the settings file has changed.
+        """
+        now = time.time()
+        if self.path is None or now - self._checked < self.interval:
+            return
+        with self._lock:
+            self._checked = now
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                return
+            if mtime != self._mtime:
+                # Whatever happens, don't read this version of the file again
+                self._mtime = mtime
+                try:
+                    config = Config(app.root_path)
+                    config.from_pyfile(self.path)
+                    self.load(config)
+                except Exception:
+                    app.logger.exception("Could not reload access keys from %s; keeping the old keys", self.path)
+
+    def grant(self, keyname, key):
+        """
+        Check a key. Returns a grant to keep in the session if it is valid,
+        else None.
+        """
+        self.refresh()
+        digest = accesskey_digest(key)
+        if digest in self._keys.get(keyname, ()):
+            return [digest, self._fingerprints[keyname], int(time.time()) + self.ttl]
+
+    def verify(self, keyname, grant):
+        """
+        Check a grant from the session. Returns the grant, renewed if the
+        keys have changed since it was made but its key is still valid, or
+        None if it is no longer valid. A grant made since the last change
+        is trusted until it expires without looking up its key.
+        """
+        if not isinstance(grant, list) or len(grant) != 3 or grant[2] < time.time():
+            return None
+        self.refresh()
+        digest, fingerprint, expires = grant
+        if fingerprint == self._fingerprints.get(keyname):
+            return grant
+        if digest in self._keys.get(keyname, ()):
+            return [digest, self._fingerprints[keyname], expires]
+
+
+def edition_counters(edition):
+    """
+    Return participant counts for an edition, broken down by approval, RSVP,
+    attendance, category, t-shirt size and referrer. All breakdowns are
+    folded from a single grouped query.
+    """
+    counters = {
+        'total': 0,
+        'approved': {True: 0, False: 0},
+        'rsvp': {'Y': 0, 'N': 0, 'M': 0, 'A': 0},  # Approved participants only
+        'attended': {True: 0, False: 0},
+        'category': defaultdict(int),
+        'tshirtsize': defaultdict(int),
+        'referrer': defaultdict(int),
+        }
+    for approved, rsvp, attended, category, tshirtsize, referrer, count in edition_counter_query(edition):
+        counters['total'] += count
+        counters['approved'][approved] += count
+        if approved:
+            counters['rsvp'][rsvp] = counters['rsvp'].get(rsvp, 0) + count
+        counters['attended'][attended] += count
+        counters['category'][str(category)] += count
+        counters['tshirtsize'][str(tshirtsize)] += count
+        counters['referrer'][str(referrer)] += count
+    return counters
+
+
+def edition_counter_query(edition):
+    """
+    Query for an edition's participant counts, grouped by each column that
+    :func:`edition_counters` breaks them down by.
+    """
+    return db.session.query(
+        Participant.approved, Participant.rsvp, Participant.attended,
+        Participant.category, Participant.tshirtsize, Participant.referrer,
+        db.func.count(Participant.id)
+        ).filter_by(edition=edition).group_by(
+        Participant.approved, Participant.rsvp, Participant.attended,
+        Participant.category, Participant.tshirtsize, Participant.referrer)
+
+
+class MemoryPageCache(object):
+    """
+    Page cache held in this process, keeping at most ``maxsize`` pages and
+    discarding the least recently used.
+    """
+    def __init__(self, ttl, maxsize=100):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._pages = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is None:
+                return None
+            if page['cached'] + self.ttl < time.time():
+                del self._pages[key]
+                return None
+            self._pages.move_to_end(key)
+            return page
+
+    def set(self, key, page):
+        with self._lock:
+            self._pages[key] = page
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.maxsize:
+                self._pages.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+
+class FilesystemPageCache(object):
+    """
+    Page cache stored as files in a directory, shared by all worker processes
+    on a server. Expired pages are removed when read, and pages that are no
+    longer read are swept out by :meth:`set` at most once per ``ttl``.
+    """
+    def __init__(self, ttl, path):
+        self.ttl = ttl
+        self.path = path
+        self._swept = time.time()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename) as f:
+                page = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if page['cached'] + self.ttl < time.time():
+            self._remove(filename)
+            return None
+        return page
+
+    def set(self, key, page):
+        # Write to a temporary file and rename, so readers never see half a page
+        fd, tmpname = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(page, f)
+        os.rename(tmpname, self._filename(key))
+        if self._swept + self.ttl < time.time():
+            self._swept = time.time()
+            self.sweep()
+
+    def sweep(self):
+        """
+        Remove pages that expired, and temporary files left by writers that
+        died, going by modification time.
+        """
+        expired = time.time() - self.ttl
+        for filename in os.listdir(self.path):
+            filename = os.path.join(self.path, filename)
+            try:
+                if os.path.getmtime(filename) < expired:
+                    self._remove(filename)
+            except OSError:
+                pass  # Removed by another process
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass  # Removed or replaced by another process
+
+    def clear(self):
+        for filename in os.listdir(self.path):
+            if filename.endswith('.json'):
+                os.remove(os.path.join(self.path, filename))
+
+
+#: Stands in for flashed messages in cached pages
+FLASH_MARKER = '<!--[flashes]-->'
+
+#: Page cache hits and misses
+pagecache_counters = {'hits': 0, 'misses': 0, 'bypassed': 0}
+
+
+def pagecache(f):
+    """
+    Decorator that caches a route's response for anonymous GET requests
+    without a query string. Flashed messages are left out of the cached page
+    and filled in for each request. Cached responses support conditional
+    requests with ETag and Last-Modified.
+
+    Only requests for the hosts in :data:`page_cache_hosts` are cached, since
+    the Host header is chosen by the client and pages may contain absolute
+    URLs made from it.
+    """
+    @wraps(f)
+    def wrapped(*args, **kw):
+        if (page_cache is None or request.method != 'GET' or request.args or kw or
+                request.host.lower() not in page_cache_hosts or
+                session.get('user_id') or session.get('userid')):
+            pagecache_counters['bypassed'] += 1
+            return f(*args, **kw)
+        key = request.scheme + '://' + request.host.lower() + request.path
+        page = page_cache.get(key)
+        if page is None:
+            pagecache_counters['misses'] += 1
+            g.page_skeleton = True
+            response = app.make_response(f(*args, **kw))
+            g.page_skeleton = False
+            if response.status_code != 200:
+                return response
+            body = response.get_data(as_text=True)
+            page = {'body': body,
+                    'content_type': response.content_type,
+                    'etag': hashlib.sha1(body.encode('utf-8')).hexdigest(),
+                    'cached': time.time()}
+            page_cache.set(key, page)
+        else:
+            pagecache_counters['hits'] += 1
+
+        if session.get('_flashes'):
+            # The page differs from the cached copy, so don't let it be cached
+            body = page['body'].replace(FLASH_MARKER, render_template('flashes.html'))
+            return Response(body, content_type=page['content_type'])
+        response = Response(page['body'].replace(FLASH_MARKER, ''), content_type=page['content_type'])
+        response.set_etag(page['etag'])
+        response.last_modified = datetime.utcfromtimestamp(int(page['cached']))
+        response.cache_control.no_cache = True  # Always revalidate
+        return response.make_conditional(request)
+    return wrapped
+
+
+def asset_urls(bundle):
+    """
+    Return (url, media) pairs for a bundle of static assets: the built bundle
+    if ``buildassets`` has been run, else each of its source files. Source
+    file URLs are worked out once per process, or on every call in debug
+    mode so that edits show up at once.
+    """
+    if bundle in asset_manifest:
+        return [(url_for('static', filename=asset_manifest[bundle]), None)]
+    urls = asset_source_urls.get(bundle)
+    if urls is None or app.debug:
+        urls = []
+        for filename, media in ASSET_BUNDLES[bundle]:
+            # Bust browser caches when the file changes
+            mtime = int(os.path.getmtime(os.path.join(app.static_folder, filename)))
+            urls.append((url_for('static', filename=filename, v=mtime), media))
+        asset_source_urls[bundle] = urls
+    return urls
+
+
+def load_asset_manifest():
+    """
+    Read the bundle name -> built file map written by ``buildassets``.
+    """
+    try:
+        with open(os.path.join(app.static_folder, 'assets.json')) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def minify_css(css):
+    """
+    Minify CSS with rcssmin if available. Without it the source is returned
+    unchanged, since it takes a real parser to leave strings and ``url()``
+    values alone.
+    """
+    if rcssmin is not None:
+        return rcssmin.cssmin(css)
+    return css
+
+
+def minify_js(js):
+    """
+    Minify JavaScript with rjsmin if available. Without it the source is
+    returned unchanged, since most of it is already minified.
+    """
+    if rjsmin is not None:
+        return rjsmin.jsmin(js)
+    return js
+
+
+def build_bundle(bundle):
+    """
+    Concatenate and minify a bundle's files, write the result under a name
+    containing its content hash along with .gz and .br (if brotli is
+    installed) copies, and return the new file's path under static/.
+    """
+    parts = []
+    for filename, media in ASSET_BUNDLES[bundle]:
+        with open(os.path.join(app.static_folder, filename), encoding='utf-8') as f:
+            source = f.read()
+        if bundle.endswith('.css'):
+            source = minify_css(source)
+            if media:
+                source = '@media %s{%s}' % (media, source)
+        else:
+            # Guard against files that don't end their last statement
+            source = minify_js(source).rstrip() + ';'
+        parts.append(source)
+    content = '\n'.join(parts).encode('utf-8')
+    base, ext = os.path.splitext(bundle)
+    built = '%s.%s%s' % (base, hashlib.sha1(content).hexdigest()[:12], ext)
+    path = os.path.join(app.static_folder, built)
+    with open(path, 'wb') as f:
+        f.write(content)
+    with open(path + '.gz', 'wb') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=9, mtime=0) as gz:
+            gz.write(content)
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(content))
+    return built
+
+
+def picture(filename, alt, width=None, height=None):
+    """
+    Return markup for an image under static/. If ``buildimages`` has made
+    variants of it, this is a <picture> element offering WebP and resized
+    copies with srcset, else a plain <img>. ``width`` is the display width
+    in CSS pixels, which lets the browser pick a variant for the screen.
+    """
+    attrs = Markup('')
+    if width:
+        attrs += Markup(' width="%d"') % width
+    if height:
+        attrs += Markup(' height="%d"') % height
+    entry = image_manifest.get(filename)
+    if entry is None:
+        return Markup('<img src="%s"%s alt="%s"/>') % (url_for('static', filename=filename), attrs, alt)
+
+    def srcset(variants):
+        return ', '.join('%s %dw' % (url_for('static', filename=path), w) for w, path in variants)
+    sizes = '%dpx' % (width or entry['width'])
+    markup = Markup('<picture>')
+    if entry['webp']:
+        markup += Markup('<source type="image/webp" srcset="%s" sizes="%s"/>') % (srcset(entry['webp']), sizes)
+    largest = entry['original'][-1][1]
+    markup += Markup('<img src="%s" srcset="%s" sizes="%s"%s alt="%s"/></picture>') % (
+        url_for('static', filename=largest), srcset(entry['original']), sizes, attrs, alt)
+    return markup
+
+
+def load_image_manifest():
+    """
+    Read the image -> variants map written by ``buildimages``.
+    """
+    try:
+        with open(os.path.join(app.static_folder, 'img', 'opt', 'manifest.json')) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def build_image_variants(filename):
+    """
+    Write recompressed, resized and WebP copies of a PNG or JPEG under
+    static/img/opt and return its manifest entry: its size and lists of
+    (width, file) for same-format and WebP variants, smallest first.
+
+    Full-size PNGs are recompressed losslessly, as are full-size WebPs made
+    from PNGs. A full-size PNG copy is only used if it is smaller than the
+    original. Full-size JPEGs are served as the original file, since Pillow
+    can't save a JPEG without decoding and re-encoding it.
+    """
+    source = os.path.join(app.static_folder, filename)
+    image = Image.open(source)
+    image.load()
+    base, ext = os.path.splitext(os.path.relpath(filename, 'img'))
+    is_png = image.format == 'PNG'
+    webp = image_features.check('webp')
+    entry = {'width': image.width, 'height': image.height, 'original': [], 'webp': []}
+    for width in sorted({w for w in IMAGE_WIDTHS if w < image.width} | {image.width}):
+        outbase = os.path.join('img', 'opt', '%s-%d' % (base, width))
+        outpath = os.path.join(app.static_folder, outbase)
+        if not os.path.isdir(os.path.dirname(outpath)):
+            os.makedirs(os.path.dirname(outpath))
+        if width == image.width:
+            resized = image
+        else:
+            resized = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        if is_png:
+            resized.save(outpath + ext, 'PNG', optimize=True)
+        elif width != image.width:
+            resized.save(outpath + ext, 'JPEG', quality=90, optimize=True, progressive=True)
+        if width == image.width and (not is_png or os.path.getsize(outpath + ext) >= os.path.getsize(source)):
+            if os.path.exists(outpath + ext):
+                os.remove(outpath + ext)
+            entry['original'].append((width, filename))
+        else:
+            entry['original'].append((width, outbase + ext))
+        if webp:
+            if is_png:
+                resized.save(outpath + '.webp', 'WEBP', lossless=True, method=6)
+            else:
+                resized.save(outpath + '.webp', 'WEBP', quality=90, method=6)
+            entry['webp'].append((width, outbase + '.webp'))
+    # Don't offer WebP if it doesn't save bytes
+    if sum(os.path.getsize(os.path.join(app.static_folder, path)) for w, path in entry['webp']) >= sum(
+            os.path.getsize(os.path.join(app.static_folder, path)) for w, path in entry['original']):
+        for w, path in entry['webp']:
+            os.remove(os.path.join(app.static_folder, path))
+        entry['webp'] = []
+    return entry
+
+
+class ParticipantLookup(object):
+    """
+    Per-edition :class:`lookup.LookupIndex` of participants, built on first
+    use. Participants registered in this process are added at once; those
+    registered elsewhere are picked up at most every ``refresh`` seconds.
+    Counts searches by the kind of match found.
+
+    Ids from the database's sequence don't always commit in order, so each
+    refresh scans again from ``window`` ids below the highest it has seen.
+    """
+    def __init__(self, refresh=5, window=1000):
+        self.refresh = refresh
+        self.window = window
+        self.counters = defaultdict(int)
+        self._indexes = {}
+        self._building = {}
+        self._checked = {}
+        self._scanned = {}
+        self._scanning = set()
+        self._lock = Lock()
+
+    def index(self, edition):
+        with self._lock:
+            index = self._indexes.get(edition)
+            building = self._building.get(edition)
+            if index is None and building is None:
+                # This thread builds the index; others for the edition wait for it
+                self._building[edition] = Event()
+            # One thread rescans an edition per interval; others search the index as it is
+            due = (index is not None and edition not in self._scanning and
+                   time.time() - self._checked.get(edition, 0) >= self.refresh)
+            if due:
+                self._scanning.add(edition)
+            scanned = self._scanned.get(edition, 0)
+        if building is not None:
+            building.wait()
+            return self._indexes[edition]
+        if index is None:
+            index = LookupIndex()
+            checked = 0  # If the scan fails, the next search scans again
+            try:
+                scanned = self._scan(edition, index, scanned)
+                checked = time.time()
+            finally:
+                with self._lock:
+                    self._indexes[edition] = index
+                    self._scanned[edition] = scanned
+                    self._checked[edition] = checked
+                    self.counters['builds'] += 1
+                    self._building.pop(edition).set()
+        elif due:
+            try:
+                scanned = self._scan(edition, index, scanned)
+            finally:
+                with self._lock:
+                    self._scanned[edition] = scanned
+                    self._checked[edition] = time.time()
+                    self._scanning.discard(edition)
+        return index
+
+    def _scan(self, edition, index, scanned):
+        """
+        Add participants from the database, from ``window`` ids below
+        ``scanned``, and return the highest id seen. Runs without the lock,
+        in one thread per edition at a time.
+        """
+        for id, email, fullname in self.query(edition, scanned - self.window).yield_per(1000):
+            index.add(id, email, fullname)
+            scanned = max(scanned, id)
+        return scanned
+
+    def query(self, edition, after):
+        """
+        Query for the (id, email, fullname) of an edition's participants
+        with ids above ``after``, in order.
+        """
+        return db.session.query(Participant.id, Participant.email, Participant.fullname).filter(
+            Participant.edition == edition, Participant.id > after).order_by(Participant.id)
+
+    def add(self, participant):
+        """
+        Add a newly committed participant, if its edition is indexed.
+        """
+        index = self._indexes.get(participant.edition)
+        if index is not None:
+            with self._lock:
+                index.add(participant.id, participant.email, participant.fullname)
+
+    def search(self, edition, text, limit=10):
+        """
+        Search an edition by email, email prefix, name prefix or a fuzzy
+        match of either. Returns (ids, kind) as :meth:`LookupIndex.search`.
+        """
+        ids, kind = self.index(edition).search(text, limit)
+        self.counters['searches'] += 1
+        self.counters[kind or 'misses'] += 1
+        return ids, kind
+
+    def stats(self):
+        stats = dict(self.counters)
+        if stats.get('searches'):
+            stats['hit_rate'] = 1 - float(stats.get('misses', 0)) / stats['searches']
+        stats['participants'] = {edition: len(index) for edition, index in self._indexes.items()}
+        return stats
+
+
 def request_is_xhr():
     """
     True if the request was triggered via a JavaScript XMLHttpRequest. This only works
@@ -135,6 +939,15 @@ def request_is_xhr():
     return request.environ.get('HTTP_X_REQUESTED_WITH', '').lower() == 'xmlhttprequest'
 
 
+def stream_template(name, **context):
+    """
+    Render a template a piece at a time, for pages too long to build in
+    memory. Wrap the result in :func:`stream_with_context`.
+    """
+    app.update_template_context(context)
+    return app.jinja_env.get_template(name).generate(context)
+
+
 # ---------------------------------------------------------------------------
 # Data models and forms
 
@@ -148,6 +961,8 @@ class Participant(db.Model):
     fullname = db.Column(db.Unicode(80), nullable=False)
     #: User's email address
     email = db.Column(db.Unicode(80), nullable=False)
+    #: Email address normalized for duplicate detection, from :func:`lookup.email_key`
+    email_key = db.Column(db.Unicode(80), nullable=False)
     #: Edition of the event they'd like to attend
     edition = db.Column(db.Unicode(80), nullable=False)
     #: User's company name
@@ -166,6 +981,10 @@ class Participant(db.Model):
     category = db.Column(db.Integer, nullable=False, default=0)
     #: User agent with which the user registered
     useragent = db.Column(db.Unicode(250), nullable=True)
+    #: Browser, major version and platform, parsed from the user agent
+    ua_browser = db.Column(db.Unicode(40), nullable=True)
+    ua_version = db.Column(db.Unicode(20), nullable=True)
+    ua_platform = db.Column(db.Unicode(40), nullable=True)
     #: Date the user registered
     regdate = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     #: Submitter's IP address, for logging (45 chars to accommodate an IPv6 address)
@@ -189,6 +1008,39 @@ class Participant(db.Model):
     #: Link to user account
     user = db.relation('User', backref='participants')
 
+    __table_args__ = (
+        #: Every admin view filters by edition; the list and sign-in sheet also sort by name
+        db.Index('ix_participant_edition_fullname', 'edition', 'fullname'),
+        #: Venue desk lookups
+        db.Index('ix_participant_edition_email', 'edition', 'email'),
+        #: Duplicate checks
+        db.Index('ix_participant_edition_email_key', 'edition', 'email_key'),
+        #: RSVP statistics
+        db.Index('ix_participant_edition_approved_rsvp', 'edition', 'approved', 'rsvp'),
+        #: Attendee statistics
+        db.Index('ix_participant_edition_attended', 'edition', 'attended'),
+        #: Tables sorted by registration date
+        db.Index('ix_participant_edition_regdate', 'edition', 'regdate'),
+        #: RSVP by access key, and the User.participants backref
+        db.Index('ix_participant_user_id_edition', 'user_id', 'edition'),
+        )
+
+    @validates('email')
+    def _set_email_key(self, key, email):
+        self.email_key = email_key(email)
+        return email
+
+    def set_useragent(self, useragent):
+        """
+        Record the user agent along with its parsed browser and platform.
+        """
+        useragent = normalize_useragent(useragent)
+        self.useragent = useragent
+        if useragent:
+            self.ua_browser, self.ua_version, self.ua_platform = uaclassifier.classify(useragent)
+        else:
+            self.ua_browser = self.ua_version = self.ua_platform = None
+
 
 class User(UuidMixin, db.Model):
     """
@@ -218,17 +1070,102 @@ class User(UuidMixin, db.Model):
         if password is None:
             self.pw_hash = None
         else:
-            self.pw_hash = generate_password_hash(password)
+            self.pw_hash = password_hasher.hash(password)
 
     password = property(fset=_set_password)
 
     def check_password(self, password):
-        return check_password_hash(self.pw_hash, password)
+        return password_hasher.verify(self.pw_hash, password)
 
     def __repr__(self):
         return '<User %s>' % (self.email)
 
 
+class Job(db.Model):
+    """
+    A side effect of a request, such as sending mail, to be run later by the
+    ``worker`` command. Jobs are committed in the same transaction as the
+    data they act on, so the worker only sees jobs whose request succeeded.
+    """
+    __tablename__ = 'job'
+    id = db.Column(db.Integer, primary_key=True)
+    #: Job kind, a key in :data:`job_handlers`
+    kind = db.Column(db.Unicode(40), nullable=False)
+    #: JSON-encoded keyword arguments for the handler
+    payload = db.Column(db.UnicodeText, nullable=False, default='{}')
+    #: Status codes:
+    #: P = Pending
+    #: R = Running
+    #: D = Done
+    #: F = Failed, no more retries
+    status = db.Column(db.Unicode(1), nullable=False, default='P')
+    #: Number of times this job has been started
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    #: Don't run before this time (used to back off retries)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    #: Error from the last failed attempt
+    last_error = db.Column(db.UnicodeText, nullable=True)
+    #: Date of creation
+    created_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    #: Date of last status change
+    updated_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        #: The worker looks for pending jobs that are due
+        db.Index('ix_job_status_run_after', 'status', 'run_after'),
+        )
+
+    def __repr__(self):
+        return '<Job %s %s %s>' % (self.id, self.kind, self.status)
+
+
+class AttendanceLog(db.Model):
+    """
+    A change to a participant's attendance. The id is a version number that
+    sign-in sheets poll to catch up on changes made at other desks.
+    """
+    __tablename__ = 'attendance_log'
+    id = db.Column(db.Integer, primary_key=True)
+    #: Edition, repeated from the participant so the feed needs no join
+    edition = db.Column(db.Unicode(80), nullable=False)
+    #: Participant whose attendance changed
+    participant_id = db.Column(db.Integer, db.ForeignKey('participant.id'), nullable=False)
+    #: Did the participant attend?
+    attended = db.Column(db.Boolean, nullable=False)
+    #: Date of change
+    created_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        #: Changes since a version, per edition
+        db.Index('ix_attendance_log_edition_id', 'edition', 'id'),
+        )
+
+
+class MailChimpMember(db.Model):
+    """
+    What was last sent to MailChimp for a list member, so that a sync sends
+    only what has changed.
+    """
+    __tablename__ = 'mailchimp_member'
+    id = db.Column(db.Integer, primary_key=True)
+    #: Email address on the list
+    email = db.Column(db.Unicode(80), nullable=False, unique=True)
+    #: SHA1 of the merge vars last subscribed with
+    digest = db.Column(db.String(40), nullable=True)
+    #: Status codes:
+    #: S = Subscribed
+    #: U = Unsubscribed
+    #: E = Error; sent again at the next sync
+    status = db.Column(db.Unicode(1), nullable=False)
+    #: Error from MailChimp, if status is E
+    last_error = db.Column(db.UnicodeText, nullable=True)
+    #: Date of last sync
+    updated_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<MailChimpMember %s %s>' % (self.email, self.status)
+
+
 class RegisterForm(Form):
     fullname = TextField('Full name', validators=[DataRequired()])
     email = TextField('Email address', validators=[DataRequired(), Email()])
@@ -259,7 +1196,12 @@ class LoginForm(Form):
     password = PasswordField('Password', validators=[DataRequired()])
 
     def getuser(self, name):
-        return User.query.filter_by(email=name).first()
+        # Both validators need the user, so look it up only once
+        if not hasattr(self, '_users'):
+            self._users = {}
+        if name not in self._users:
+            self._users[name] = User.query.filter_by(email=name).first()
+        return self._users[name]
 
     def validate_username(self, field):
         existing = self.getuser(field.data)
@@ -270,8 +1212,18 @@ class LoginForm(Form):
 
     def validate_password(self, field):
         user = self.getuser(self.email.data)
-        if user is None or not user.check_password(field.data):
-            raise ValidationError("Incorrect password")
+        try:
+            if user is None or not user.check_password(field.data):
+                raise ValidationError("Incorrect password")
+        except HasherBusy:
+            raise ValidationError("We're a little busy. Please try again in a moment")
+        if password_hasher.needs_rehash(user.pw_hash):
+            # Hashing settings have changed since this password was set. If
+            # the pool is busy, leave it for the next login
+            try:
+                user.password = field.data
+            except HasherBusy:
+                pass
         self.user = user
 
 
@@ -279,6 +1231,7 @@ class LoginForm(Form):
 # Routes
 
 @app.route('/', methods=['GET'])
+@pagecache
 @getuser
 def index(**forms):
     regform = forms.get('regform', RegisterForm())
@@ -290,6 +1243,7 @@ def index(**forms):
 
 
 @app.route('/sitemap.xml')
+@pagecache
 def sitemap():
     """
     Return a sitemap. There is only one page for web crawlers.
@@ -325,16 +1279,15 @@ def loginkey():
     if user.firstuse_date is None:
         user.firstuse_date = datetime.utcnow()
         db.session.commit()
-    g.user = user
-    session['userid'] = user.email
+        user_cache.delete(user.id)
+    login(user)
     flash("You are now logged in", 'info')
     return redirect(url_for('index'), code=303)
 
 
 @app.route('/logout')
 def logout():
-    g.user = None
-    del session['userid']
+    logout_user()
     return redirect(url_for('index'), code=303)
 
 
@@ -374,6 +1327,7 @@ def favicon():
 
 
 @app.route('/robots.txt')
+@pagecache
 def robots():
     # Disable support for indexing fragments, since there's no backing code
     return Response("Sitemap: /sitemap.xml\n"
@@ -381,6 +1335,114 @@ def robots():
                     content_type='text/plain; charset=utf-8')
 
 
+@app.endpoint('static')
+def static(filename):
+    """
+    Serve a static file. Replaces Flask's static view to add strong ETags,
+    precompressed .br and .gz copies, byte ranges, and hand-off to the front
+    server with X-Sendfile (USE_X_SENDFILE) or X-Accel-Redirect
+    (STATIC_ACCEL_REDIRECT).
+    """
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = None
+    accepted = request.accept_encodings
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if accepted[candidate] and os.path.isfile(path + suffix):
+            encoding = candidate
+            path += suffix
+            filename += suffix
+            break
+    mtime, size, etag = static_etags.get(path)
+
+    accel = app.config.get('STATIC_ACCEL_REDIRECT')
+    frontserver = accel or app.use_x_sendfile
+    if accel:
+        # The front server sends the file and handles ranges
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = accel.rstrip('/') + '/' + filename
+    else:
+        response = send_file(path, mimetype=mimetype, add_etags=False, conditional=False,
+                             cache_timeout=app.get_send_file_max_age(filename))
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    response.last_modified = datetime.utcfromtimestamp(int(mtime))
+    response.cache_control.public = True
+    response.cache_control.max_age = app.get_send_file_max_age(filename)
+    if frontserver:
+        # The body is empty, so leave ranges to the front server. Answer a
+        # matching If-None-Match or If-Modified-Since here, though, since the
+        # front server would send the whole file
+        if not is_resource_modified(request.environ, etag=etag, last_modified=response.last_modified):
+            response.status_code = 304
+            for header in ('X-Accel-Redirect', 'X-Sendfile', 'Content-Length'):
+                response.headers.pop(header, None)
+        return response
+    return response.make_conditional(request, accept_ranges=True, complete_length=size)
+
+
+class StaticETags(object):
+    """
+    Strong ETags for static files, computed from their content when a file
+    is first requested and recomputed only if its modification time or size
+    changes.
+    """
+    def __init__(self):
+        self._etags = {}
+
+    def get(self, path):
+        stat = os.stat(path)
+        item = self._etags.get(path)
+        if item is None or item[0] != stat.st_mtime or item[1] != stat.st_size:
+            digest = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(65536), b''):
+                    digest.update(block)
+            item = self._etags[path] = (stat.st_mtime, stat.st_size, digest.hexdigest())
+        return item
+
+
+def compress_static(path):
+    """
+    Write .gz and (if brotli is installed) .br copies of a file, skipping
+    any that don't save space. Returns the suffixes written.
+    """
+    with open(path, 'rb') as f:
+        content = f.read()
+    written = []
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as gz:
+        gz.write(content)
+    variants = [('.gz', buf.getvalue())]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(content)))
+    for suffix, compressed in variants:
+        if len(compressed) < len(content):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+            written.append(suffix)
+        elif os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    return written
+
+
+@app.after_request
+def cache_built_assets(response):
+    """
+    Built asset bundles never change (a change makes a new file name), so
+    browsers may cache them indefinitely.
+    """
+    if request.endpoint == 'static' and response.status_code in (200, 206, 304) and \
+            request.view_args.get('filename') in built_assets:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        response.expires = datetime.utcnow() + timedelta(days=365)
+    return response
+
+
 @app.route('/adsense')
 def adsense():
     """Hidden page for Google AdSense application."""
@@ -400,6 +1462,9 @@ def adstxt():
 
 @app.route('/', methods=['POST'])
 def submit():
+    limited = check_rate_limits()
+    if limited is not None:
+        return limited
     # There's only one form, so we don't need to check which one was submitted
     formid = request.form.get('form.id')
     if formid == 'regform':
@@ -408,7 +1473,43 @@ def submit():
         return submit_login()
     else:
         flash("Unknown form", 'error')
-        redirect(url_for('index'), code=303)
+        return redirect(url_for('index'), code=303)
+
+
+def check_rate_limits():
+    """
+    Return a 429 response if this submission is over a rate limit in
+    RATE_LIMITS, else None. The limit per IP address is checked before the
+    form is parsed; then the limits for the form, per IP address and per
+    email address.
+    """
+    if rate_limiter is None:
+        return None
+    limits = app.config.get('RATE_LIMITS', DEFAULT_RATE_LIMITS)
+    ipaddr = request.environ['REMOTE_ADDR']
+    if 'ip' in limits:
+        wait = rate_limiter.allow('ip:' + ipaddr, limits['ip'][0] / 60.0, limits['ip'][1])
+        if wait:
+            return rate_limit_response('ip', wait)
+    formid = request.form.get('form.id')
+    if formid in limits:
+        rate, burst = limits[formid]
+        checks = [('%s:ip:%s' % (formid, ipaddr), formid + '.ip')]
+        if request.form.get('email'):
+            checks.append(('%s:email:%s' % (formid, email_key(request.form['email'])), formid + '.email'))
+        for key, scope in checks:
+            wait = rate_limiter.allow(key, rate / 60.0, burst)
+            if wait:
+                return rate_limit_response(scope, wait)
+    ratelimit_counters['allowed'] += 1
+    return None
+
+
+def rate_limit_response(scope, wait):
+    ratelimit_counters['limited'] += 1
+    ratelimit_counters['limited.' + scope] += 1
+    return Response("Too many attempts. Please try again in a minute.", 429,
+                    {'Retry-After': str(int(wait) + 1)}, mimetype='text/plain')
 
 
 def submit_register():
@@ -416,12 +1517,17 @@ def submit_register():
     # via thread globals.
     form = RegisterForm()
     if form.validate_on_submit():
+        # Repeat registrations are kept, as they may carry corrections, and
+        # listed for admins by admin_duplicates
+        if registration_spool is not None and spool_registration(form):
+            return render_template('regsuccess.html')
         participant = Participant()
         form.populate_obj(participant)
         participant.ipaddr = request.environ['REMOTE_ADDR']
-        participant.useragent = request.user_agent.string
+        participant.set_useragent(request.user_agent.string)
         db.session.add(participant)
         db.session.commit()
+        participant_lookup.add(participant)
         return render_template('regsuccess.html')
     else:
         if request_is_xhr():
@@ -432,15 +1538,32 @@ def submit_register():
             return index(regform=form)
 
 
+def spool_registration(form):
+    """
+    Queue a validated registration in the registration spool. Returns False
+    if the spool is full and the registration should be written directly.
+    """
+    record = dict(form.data)
+    record.update(email_key=email_key(form.email.data), ipaddr=request.environ['REMOTE_ADDR'],
+                  useragent=normalize_useragent(request.user_agent.string),
+                  regdate=datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f'))
+    try:
+        registration_spool.append(record)
+    except SpoolFull:
+        return False
+    return True
+
+
 def submit_login():
     form = LoginForm()
     if form.validate_on_submit():
         user = form.user
-        g.user = user
-        session['userid'] = user.email
+        login(user)
         if user.firstuse_date is None:
             user.firstuse_date = datetime.utcnow()
+        if db.session.is_modified(user):
             db.session.commit()
+            user_cache.delete(user.id)
         flash("You are now logged in", 'info')
         return redirect(url_for('index'), code=303)
     else:
@@ -457,19 +1580,25 @@ def submit_login():
 
 def adminkey(keyname):
     def decorator(f):
-        def inner(edition):
+        def inner(*args, **kw):
             form = AccessKeyForm()
-            keylist = app.config[keyname]
             # check for key and call f or return form
             if 'key' in request.values:
-                if request.values.get('key') in keylist:
-                    session[keyname] = request.values['key']
+                grant = access_keys.grant(keyname, request.values['key'])
+                if grant is not None:
+                    session[keyname] = grant
                     return redirect(request.base_url, code=303)  # FIXME: Redirect to self URL
                 else:
                     flash("Invalid access key", 'error')
                     return render_template('accesskey.html', keyform=form)
-            elif keyname in session and session[keyname] in keylist:
-                return f(edition)
+            elif keyname in session:
+                grant = access_keys.verify(keyname, session[keyname])
+                if grant is None:
+                    session.pop(keyname)
+                    return render_template('accesskey.html', keyform=form)
+                if grant is not session[keyname]:
+                    session[keyname] = grant
+                return f(*args, **kw)
             else:
                 return render_template('accesskey.html', keyform=form)
         inner.__name__ = f.__name__
@@ -477,14 +1606,131 @@ def adminkey(keyname):
     return decorator
 
 
+def participant_query(*columns):
+    """
+    Query for the named :class:`Participant` columns. Rows load as named
+    tuples, so ``row.fullname`` works as it does for a Participant, but
+    without building ORM objects or reading the columns a view doesn't
+    show, such as ``reason`` and ``useragent``.
+    """
+    return db.session.query(*[getattr(Participant, name) for name in OrderedDict.fromkeys(columns)])
+
+
+def participant_page(edition, sort='name', after=None, size=100, search=None, filters=None, prefix=None,
+                     columns=None):
+    """
+    Return one page of an edition's participants and the id of the last
+    participant on it if there are more pages, else None.
+
+    Pages are keyset paginated on (sort column, id) so that every page costs
+    the same. ``sort`` is a key in :data:`TABLE_SORTS`, prefixed with ``-``
+    for descending order. ``after`` is the id that ended the previous page.
+    ``search`` matches name, email or company, and ``filters`` is a
+    dictionary of exact column matches. ``prefix`` matches the start of the
+    name as a range on the (edition, fullname) index, trying the prefix as
+    typed, in lower case and in title case. If ``columns`` are named, rows
+    are loaded with :func:`participant_query` instead of as Participants.
+    """
+    rows = participant_page_query(edition, sort, after, search, filters, prefix, columns).limit(size + 1).all()
+    if len(rows) > size:
+        return rows[:size], rows[size - 1].id
+    return rows, None
+
+
+def participant_page_query(edition, sort='name', after=None, search=None, filters=None, prefix=None, columns=None):
+    """
+    Query for the participants from ``after`` onwards, in page order. Takes
+    the arguments of :func:`participant_page` except ``size``.
+    """
+    descending = sort.startswith('-')
+    column = getattr(Participant, TABLE_SORTS[sort.lstrip('-')])
+    if columns:
+        query = participant_query('id', *columns)
+    else:
+        query = Participant.query
+    query = query.filter(Participant.edition == edition).filter_by(**(filters or {}))
+    if search:
+        pattern = '%%%s%%' % search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = query.filter(db.or_(Participant.fullname.ilike(pattern, escape='\\'),
+                                    Participant.email.ilike(pattern, escape='\\'),
+                                    Participant.company.ilike(pattern, escape='\\')))
+    if prefix:
+        query = query.filter(db.or_(*[db.and_(Participant.fullname >= variant,
+                                              Participant.fullname < variant + u'\uffff')
+                                      for variant in sorted({prefix, prefix.lower(), prefix.title()})]))
+    if after is not None:
+        anchor = db.session.query(column).filter(Participant.id == after).scalar()
+        if anchor is not None:
+            if descending:
+                query = query.filter(db.or_(column < anchor, db.and_(column == anchor, Participant.id < after)))
+            else:
+                query = query.filter(db.or_(column > anchor, db.and_(column == anchor, Participant.id > after)))
+    if descending:
+        query = query.order_by(column.desc(), Participant.id.desc())
+    else:
+        query = query.order_by(column, Participant.id)
+    return query
+
+
+def datatable(edition, headers, rowformat, title, sort='name', columns=None):
+    """
+    Render a paginated table of an edition's participants. ``rowformat`` makes
+    a dictionary of display values for a participant, keyed as in ``headers``,
+    and ``columns`` names the Participant columns it reads.
+
+    Query parameters: ``sort``, ``after`` (cursor), ``start`` (rows before this
+    page), ``size``, ``q`` (search) and ``approved``, ``attended`` or ``rsvp``
+    (filters). Returns JSON if ``format=json``, table rows alone for XHR
+    requests, and a full page otherwise.
+    """
+    args = request.args
+    sort = args.get('sort', sort)
+    if sort.lstrip('-') not in TABLE_SORTS:
+        abort(400)
+    after = args.get('after', type=int)
+    start = args.get('start', 0, type=int)
+    size = max(1, min(args.get('size', 100, type=int), 1000))
+    search = args.get('q', '').strip()
+    filters = {}
+    for name in ('approved', 'attended'):
+        if args.get(name) in ('0', '1'):
+            filters[name] = args[name] == '1'
+    if args.get('rsvp') in ('Y', 'N', 'M', 'A'):
+        filters['rsvp'] = args['rsvp']
+
+    page, lastid = participant_page(edition, sort=sort, after=after, size=size,
+                                     search=search, filters=filters, columns=columns)
+    data = []
+    for i, p in enumerate(page):
+        row = rowformat(p)
+        row['no'] = start + i + 1
+        data.append(row)
+    if lastid is not None:
+        nexturl = url_for(request.endpoint, edition=edition, sort=sort, after=lastid,
+                          start=start + len(page), size=size, q=search or None, **{
+                              k: args[k] for k in ('approved', 'attended', 'rsvp') if k in args})
+    else:
+        nexturl = None
+
+    if args.get('format') == 'json':
+        return jsonify(rows=data, next=nexturl)
+    elif request_is_xhr():
+        return render_template('datatable_rows.html', headers=headers, data=data, nexturl=nexturl)
+    else:
+        return render_template('datatable.html', headers=headers, data=data, nexturl=nexturl,
+                               title=title, sort=sort, search=search, sorts=TABLE_SORTS)
+
+
 @app.route('/admin/reasons/<edition>', methods=['GET', 'POST'])
 @adminkey('ACCESSKEY_REASONS')
 def admin_reasons(edition):
     headers = [('no', 'Sl No'), ('reason', 'Reason')]  # List of (key, label)
-    data = ({'no': i + 1, 'reason': p.reason} for i, p in
-            enumerate(Participant.query.filter_by(edition=edition)))
-    return render_template('datatable.html', headers=headers, data=data,
-                           title='Reasons for attending')
+    return datatable(edition, headers, lambda p: {'reason': p.reason},
+                     title='Reasons for attending', sort='regdate', columns=REASONS_COLUMNS)
+
+
+#: Columns read by the reasons table
+REASONS_COLUMNS = ['reason']
 
 
 @app.route('/admin/list/<edition>', methods=['GET', 'POST'])
@@ -493,38 +1739,61 @@ def admin_list(edition):
     headers = [('no', 'Sl No'), ('name', 'Name'), ('company', 'Company'),
                ('jobtitle', 'Job Title'), ('twitter', 'Twitter'),
                ('approved', 'Approved'), ('rsvp', 'RSVP'), ('attended', 'Attended')]
-    data = ({'no': i + 1, 'name': p.fullname, 'company': p.company,
-             'jobtitle': p.jobtitle,
-             'twitter': p.twitter,
-             'approved': p.approved,
-             'rsvp': {'Y': 'Yes', 'N': 'No', 'M': 'Maybe', 'A': 'Awaiting'}[p.rsvp],
-             'attended': ['No', 'Yes'][p.attended]
-             } for i, p in enumerate(Participant.query.order_by('fullname').filter_by(edition=edition)))
-    return render_template('datatable.html', headers=headers, data=data,
-                           title='List of participants')
+    d_rsvp = {'Y': 'Yes', 'N': 'No', 'M': 'Maybe', 'A': 'Awaiting'}
+    return datatable(edition, headers, lambda p: {
+        'name': p.fullname, 'company': p.company,
+        'jobtitle': p.jobtitle,
+        'twitter': p.twitter,
+        'approved': p.approved,
+        'rsvp': d_rsvp[p.rsvp],
+        'attended': ['No', 'Yes'][p.attended]
+        }, title='List of participants', sort='name', columns=LIST_COLUMNS)
+
+
+#: Columns read by the participant list
+LIST_COLUMNS = ['fullname', 'company', 'jobtitle', 'twitter', 'approved', 'rsvp', 'attended']
 
 
 @app.route('/admin/rsvp/<edition>', methods=['GET', 'POST'])
 @adminkey('ACCESSKEY_LIST')
 def admin_rsvp(edition):
-    rsvp_yes = Participant.query.filter_by(edition=edition, approved=True, rsvp='Y').count()
-    rsvp_no = Participant.query.filter_by(edition=edition, approved=True, rsvp='N').count()
-    rsvp_maybe = Participant.query.filter_by(edition=edition, approved=True, rsvp='M').count()
-    rsvp_awaiting = Participant.query.filter_by(edition=edition, approved=True, rsvp='A').count()
-
-    return render_template('rsvp.html', yes=rsvp_yes, no=rsvp_no,
-                           maybe=rsvp_maybe, awaiting=rsvp_awaiting,
+    rsvp = edition_counters(edition)['rsvp']
+    return render_template('rsvp.html', yes=rsvp['Y'], no=rsvp['N'],
+                           maybe=rsvp['M'], awaiting=rsvp['A'],
                            title='RSVP Statistics')
 
 
+@app.route('/admin/counters/<edition>', methods=['GET', 'POST'])
+@adminkey('ACCESSKEY_LIST')
+def admin_counters(edition):
+    """
+    Participant counters as JSON, for dashboards to poll.
+    """
+    counters = edition_counters(edition)
+    # JSON keys must be strings
+    counters['approved'] = {'yes': counters['approved'][True], 'no': counters['approved'][False]}
+    counters['attended'] = {'yes': counters['attended'][True], 'no': counters['attended'][False]}
+    counters['edition'] = edition
+    return jsonify(counters)
+
+
 @app.route('/admin/stats/<edition>', methods=['GET', 'POST'])
 @adminkey('ACCESSKEY_LIST')
 def admin_stats(edition):
+    charts = stats_cache.get(edition)
+    if charts is None:
+        charts = useragent_charts(edition)
+        stats_cache.set(edition, charts)
+    return render_template('stats.html', **charts)
 
-    # Chart sizes
-    CHART_X = 800
-    CHART_Y = 370
 
+def useragent_charts(edition):
+    """
+    Make browser, browser version and platform charts for all registrations
+    and for those present at the venue. Reads the user agent breakdown parsed
+    at registration time (see the ``backfilluseragents`` command for older
+    records) in a single grouped query.
+    """
     all_browsers = defaultdict(int)
     all_brver = defaultdict(int)
     all_platforms = defaultdict(int)
@@ -535,78 +1804,72 @@ def admin_stats(edition):
     c_all = 0
     c_present = 0
 
-    for p in Participant.query.filter_by(edition=edition):
-        if p.useragent:
-            c_all += 1
-            ua = UserAgent(p.useragent)
-            all_browsers[ua.browser] += 1
-            if ua.version is None:
-                all_brver[ua.browser] += 1
-            else:
-                all_brver['%s %s' % (ua.browser, ua.version.split('.')[0])] += 1
-            all_platforms[ua.platform] += 1
-    for p in Participant.query.filter_by(edition=edition, attended=True):
-        if p.useragent:
-            c_present += 1
-            ua = UserAgent(p.useragent)
-            present_browsers[ua.browser] += 1
-            present_brver['%s %s' % (ua.browser, ua.version.split('.')[0])] += 1
-            present_platforms[ua.platform] += 1
-
-    if c_all != 0:  # Avoid divide by zero situation
-        f_all = 100.0 / c_all
-    else:
-        f_all = 1
-
-    if c_present != 0:  # Avoid divide by zero situation
-        f_present = 100.0 / c_present
-    else:
-        f_present = 1
-
-    # Now make charts
-    # All registrations
-    c_all_browsers = pygooglechart.PieChart2D(CHART_X, CHART_Y)
-    c_all_browsers.add_data(list(all_browsers.values()))
-    c_all_browsers.set_pie_labels(['%s (%.2f%%)' % (key, all_browsers[key] * f_all) for key in list(all_browsers.keys())])
+    for attended, browser, version, platform, count in useragent_query(edition):
+        if version is None:
+            brver = browser
+        else:
+            brver = '%s %s' % (browser, version)
+        c_all += count
+        all_browsers[browser] += count
+        all_brver[brver] += count
+        all_platforms[platform] += count
+        if attended:
+            c_present += count
+            present_browsers[browser] += count
+            present_brver[brver] += count
+            present_platforms[platform] += count
+
+    return dict(all_browsers=piechart(all_browsers, c_all),
+                all_brver=piechart(all_brver, c_all),
+                all_platforms=piechart(all_platforms, c_all),
+                present_browsers=piechart(present_browsers, c_present),
+                present_brver=piechart(present_brver, c_present),
+                present_platforms=piechart(present_platforms, c_present))
+
+
+def useragent_query(edition):
+    """
+    Query for an edition's registrations with a user agent, counted by
+    attendance and user agent breakdown.
+    """
+    return db.session.query(
+        Participant.attended, Participant.ua_browser, Participant.ua_version, Participant.ua_platform,
+        db.func.count(Participant.id)
+        ).filter(Participant.edition == edition, Participant.useragent != None).group_by(  # NOQA
+        Participant.attended, Participant.ua_browser, Participant.ua_version, Participant.ua_platform)
 
-    c_all_brver = pygooglechart.PieChart2D(CHART_X, CHART_Y)
-    c_all_brver.add_data(list(all_brver.values()))
-    c_all_brver.set_pie_labels(['%s (%.2f%%)' % (key, all_brver[key] * f_all) for key in list(all_brver.keys())])
 
-    c_all_platforms = pygooglechart.PieChart2D(CHART_X, CHART_Y)
-    c_all_platforms.add_data(list(all_platforms.values()))
-    c_all_platforms.set_pie_labels(['%s (%.2f%%)' % (key, all_platforms[key] * f_all) for key in list(all_platforms.keys())])
+def piechart(counts, total):
+    """
+    Return the URL of a pie chart showing each key's share of the total.
+    """
+    # Chart sizes
+    CHART_X = 800
+    CHART_Y = 370
 
-    # Present at venue
-    c_present_browsers = pygooglechart.PieChart2D(CHART_X, CHART_Y)
-    c_present_browsers.add_data(list(present_browsers.values()))
-    c_present_browsers.set_pie_labels(['%s (%.2f%%)' % (key, present_browsers[key] * f_present) for key in list(present_browsers.keys())])
+    if total != 0:  # Avoid divide by zero situation
+        factor = 100.0 / total
+    else:
+        factor = 1
 
-    c_present_brver = pygooglechart.PieChart2D(CHART_X, CHART_Y)
-    c_present_brver.add_data(list(present_brver.values()))
-    c_present_brver.set_pie_labels(['%s (%.2f%%)' % (key, present_brver[key] * f_present) for key in list(present_brver.keys())])
+    chart = pygooglechart.PieChart2D(CHART_X, CHART_Y)
+    chart.add_data(list(counts.values()))
+    chart.set_pie_labels(['%s (%.2f%%)' % (key, counts[key] * factor) for key in list(counts.keys())])
+    return chart.get_url()
 
-    c_present_platforms = pygooglechart.PieChart2D(CHART_X, CHART_Y)
-    c_present_platforms.add_data(list(present_platforms.values()))
-    c_present_platforms.set_pie_labels(['%s (%.2f%%)' % (key, present_platforms[key] * f_present) for key in list(present_platforms.keys())])
 
-    return render_template('stats.html',
-                           all_browsers=c_all_browsers.get_url(),
-                           all_brver=c_all_brver.get_url(),
-                           all_platforms=c_all_platforms.get_url(),
-                           present_browsers=c_present_browsers.get_url(),
-                           present_brver=c_present_brver.get_url(),
-                           present_platforms=c_present_platforms.get_url()
-                           )
+@app.route('/admin/metrics', methods=['GET', 'POST'])
+@adminkey('ACCESSKEY_LIST')
+def admin_metrics():
+    """
+    Internal counters (cache hits and misses, etc) as JSON.
+    """
+    return jsonify({name: provider() for name, provider in metrics.items()})
 
 
 @app.route('/admin/data/<edition>', methods=['GET', 'POST'])
 @adminkey('ACCESSKEY_DATA')
 def admin_data(edition):
-    d_tshirt = dict(TSHIRT_SIZES)
-    d_referrer = dict(REFERRERS)
-    d_category = dict(USER_CATEGORIES)
-    tz = timezone(app.config['TIMEZONE'])
     headers = [('no', 'Sl No'),
                ('regdate', 'Date'),
                ('name', 'Name'),
@@ -619,28 +1882,99 @@ def admin_data(edition):
                ('category', 'Category'),
                ('ipaddr', 'IP Address'),
                ('approved', 'Approved'),
-               ('RSVP', 'RSVP'),
+               ('rsvp', 'RSVP'),
                ('agent', 'User Agent'),
                ('reason', 'Reason'),
                ]
-    data = ({'no': i + 1,
-             'regdate': utc.localize(p.regdate).astimezone(tz).strftime('%Y-%m-%d %H:%M'),
-             'name': p.fullname,
-             'email': p.email,
-             'company': p.company,
-             'jobtitle': p.jobtitle,
-             'twitter': p.twitter,
-             'tshirt': d_tshirt.get(str(p.tshirtsize), p.tshirtsize),
-             'referrer': d_referrer.get(str(p.referrer), p.referrer),
-             'category': d_category.get(str(p.category), p.category),
-             'ipaddr': p.ipaddr,
-             'approved': {True: 'Yes', False: 'No'}[p.approved],
-             'rsvp': {'A': '', 'Y': 'Yes', 'M': 'Maybe', 'N': 'No'}[p.rsvp],
-             'agent': p.useragent,
-             'reason': p.reason,
-             } for i, p in enumerate(Participant.query.filter_by(edition=edition)))
-    return render_template('datatable.html', headers=headers, data=data,
-                           title='Participant data')
+    format = request.args.get('format')
+    if format not in ('csv', 'jsonl'):
+        return datatable(edition, headers, participant_formatter(),
+                         title='Participant data', sort='regdate', columns=PARTICIPANT_DATA_COLUMNS)
+    data = participant_data(edition)
+    if format == 'csv':
+        return Response(stream_with_context(csv_lines(headers, data)),
+                        content_type='text/csv; charset=utf-8',
+                        headers={'Content-Disposition': 'attachment; filename="%s.csv"' % edition})
+    elif format == 'jsonl':
+        return Response(stream_with_context(json.dumps(row, ensure_ascii=False) + '\n' for row in data),
+                        content_type='application/x-ndjson; charset=utf-8',
+                        headers={'Content-Disposition': 'attachment; filename="%s.jsonl"' % edition})
+
+
+def participant_data(edition, chunk=1000):
+    """
+    Generate a dictionary of display values for each participant in an
+    edition. Participants are loaded ``chunk`` rows at a time, over a
+    server-side cursor where the database supports one.
+    """
+    rowformat = participant_formatter()
+    query = participant_data_query(edition).execution_options(stream_results=True).yield_per(chunk)
+    for i, p in enumerate(query):
+        row = rowformat(p)
+        row['no'] = i + 1
+        yield row
+
+
+def participant_data_query(edition):
+    """
+    Query for the data export columns of an edition's participants, in
+    order of registration.
+    """
+    return participant_query(*PARTICIPANT_DATA_COLUMNS).filter(Participant.edition == edition).order_by(
+        Participant.id)
+
+
+#: Columns read by :func:`participant_formatter`
+PARTICIPANT_DATA_COLUMNS = ['regdate', 'fullname', 'email', 'company', 'jobtitle', 'twitter', 'tshirtsize',
+                            'referrer', 'category', 'ipaddr', 'approved', 'rsvp', 'useragent', 'reason']
+
+
+def participant_formatter():
+    """
+    Return a function that makes a dictionary of display values for a
+    participant, for the data table and exports.
+    """
+    d_tshirt = dict(TSHIRT_SIZES)
+    d_referrer = dict(REFERRERS)
+    d_category = dict(USER_CATEGORIES)
+    d_approved = {True: 'Yes', False: 'No'}
+    d_rsvp = {'A': '', 'Y': 'Yes', 'M': 'Maybe', 'N': 'No'}
+    localdate = localtime_formatter(timezone(app.config['TIMEZONE']), '%Y-%m-%d %H:%M')
+
+    def rowformat(p):
+        return {'regdate': localdate(p.regdate),
+                'name': p.fullname,
+                'email': p.email,
+                'company': p.company,
+                'jobtitle': p.jobtitle,
+                'twitter': p.twitter,
+                'tshirt': d_tshirt.get(str(p.tshirtsize), p.tshirtsize),
+                'referrer': d_referrer.get(str(p.referrer), p.referrer),
+                'category': d_category.get(str(p.category), p.category),
+                'ipaddr': p.ipaddr,
+                'approved': d_approved[p.approved],
+                'rsvp': d_rsvp[p.rsvp],
+                'agent': p.useragent,
+                'reason': p.reason,
+                }
+    return rowformat
+
+
+def csv_lines(headers, data):
+    """
+    Generate CSV text one line at a time: a header line with the labels in
+    ``headers``, then one line per row in ``data``.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    keys = [key for key, label in headers]
+    writer.writerow([label for key, label in headers])
+    for row in data:
+        writer.writerow([row[key] for key in keys])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
 
 
 @app.route('/admin/classify/<edition>', methods=['GET', 'POST'])
@@ -661,9 +1995,23 @@ def admin_classify(edition):
 @adminkey('ACCESSKEY_APPROVE')
 def admin_approve(edition):
     if request.method == 'GET':
-        tz = timezone(app.config['TIMEZONE'])
-        return render_template('approve.html', participants=Participant.query.filter_by(edition=edition),
-                               utc=utc, tz=tz, enumerate=enumerate, edition=edition)
+        # Rows are loaded and the page sent a thousand participants at a time
+        participants = approval_queue(edition).yield_per(1000)
+        return Response(stream_with_context(stream_template(
+            'approve.html', participants=participants, enumerate=enumerate, edition=edition,
+            formatdate=localtime_formatter(timezone(app.config['TIMEZONE']), '%Y-%m-%d %H:%M'))))
+    elif request.method == 'POST' and 'action.bulkapprove' in request.form:
+        try:
+            ids = [int(id) for id in request.form.getlist('id')]
+        except ValueError:
+            abort(400)
+        statuses = approve(edition, ids)
+        db.session.commit()
+        if request_is_xhr():
+            return jsonify(statuses)
+        else:
+            flash("Approved %d participants" % list(statuses.values()).count("Tada!"), 'info')
+            return redirect(url_for('admin_approve', edition=edition), code=303)
     elif request.method == 'POST':
         p = Participant.query.get(request.form['id'])
         if not p:
@@ -671,54 +2019,16 @@ def admin_approve(edition):
         else:
             if 'action.undo' in request.form:
                 p.approved = False
+                if p.user_id is not None:
+                    user_cache.delete(p.user_id)
                 p.user = None
                 status = 'Undone!'
                 # Remove from MailChimp
-                if MailChimp is not None and app.config['MAILCHIMP_API_KEY'] and app.config['MAILCHIMP_LIST_ID']:
-                    mc = MailChimp(app.config['MAILCHIMP_API_KEY'])
-                    try:
-                        mc.listUnsubscribe(
-                            id=app.config['MAILCHIMP_LIST_ID'],
-                            email_address=p.email,
-                            send_goodbye=False,
-                            send_notify=False,
-                            )
-                        pass
-                    except MailChimpError as e:
-                        status = e.msg
+                enqueue('mailchimp.unsubscribe', email=p.email)
                 db.session.commit()
             elif 'action.approve' in request.form:
-                if p.approved:
-                    status = "Already approved"
-                else:
-                    # Check for dupe participant (same email, same edition)
-                    dupe = False
-                    for other in Participant.query.filter_by(edition=p.edition, email=p.email):
-                        if other.id != p.id:
-                            if other.user:
-                                dupe = True
-                                break
-                    if dupe is False:
-                        p.approved = True
-                        status = "Tada!"
-                        # 1. Make user account and activate it
-                        user = makeuser(p)
-                        user.active = True
-                        # 2. Add to MailChimp
-                        if MailChimp is not None and app.config['MAILCHIMP_API_KEY'] and app.config['MAILCHIMP_LIST_ID']:
-                            mc = MailChimp(app.config['MAILCHIMP_API_KEY'])
-                            addmailchimp(mc, p)
-                        # 3. Send notice of approval
-                        msg = Message(subject="Your registration has been approved",
-                                      recipients=[p.email])
-                        msg.body = render_template("approve_notice_%s.md" % edition, p=p)
-                        msg.html = markdown(msg.body)
-                        with app.open_resource("static/doctypehtml5-%s.ics" % edition) as ics:
-                            msg.attach("doctypehtml5.ics", "text/calendar", ics.read())
-                        mail.send(msg)
-                        db.session.commit()
-                    else:
-                        status = "Dupe"
+                status = approve(p.edition, [p.id])[p.id]
+                db.session.commit()
             else:
                 status = 'Unknown action'
         if request_is_xhr():
@@ -729,6 +2039,38 @@ def admin_approve(edition):
         abort(401)
 
 
+def approval_queue(edition):
+    """
+    Query for the columns of an edition's participants that the approval
+    page shows, in order of registration.
+    """
+    return participant_query(
+        'id', 'regdate', 'fullname', 'email', 'company', 'jobtitle', 'reason', 'approved').filter(
+        Participant.edition == edition).order_by(Participant.id)
+
+
+@app.route('/admin/duplicates/<edition>', methods=['GET', 'POST'])
+@adminkey('ACCESSKEY_APPROVE')
+def admin_duplicates(edition):
+    """
+    Registrations that share an email address, ignoring case and +tags.
+    Returns JSON if ``format=json``.
+    """
+    clusters = duplicate_clusters(edition)
+    if request.args.get('format') == 'json':
+        return jsonify(clusters=[{'email_key': key, 'participants': [{
+            'id': p.id,
+            'fullname': p.fullname,
+            'email': p.email,
+            'company': p.company,
+            'regdate': p.regdate.isoformat(),
+            'approved': p.approved,
+            'user_id': p.user_id,
+            } for p in participants]} for key, participants in clusters])
+    return render_template('duplicates.html', clusters=clusters, edition=edition,
+                           formatdate=localtime_formatter(timezone(app.config['TIMEZONE']), '%Y-%m-%d %H:%M'))
+
+
 @app.route('/admin/venue/<edition>', methods=['GET', 'POST'])
 @adminkey('ACCESSKEY_APPROVE')
 def admin_venue(edition):
@@ -742,18 +2084,27 @@ def admin_venue(edition):
         if formid == 'venueregemail':
             email = request.values.get('email')
             if email:
-                p = Participant.query.filter_by(edition=edition, email=email).first()
-                if p is not None:
-                    if p.attended:  # Already signed in
-                        flash("You have already signed in. Next person please.")
-                        return redirect(url_for('admin_venue', edition=edition), code=303)
-                    else:
-                        return render_template('venueregdetails.html', edition=edition, p=p)
-            # Unknown email address. Ask for new registration
-            regform = RegisterForm()
-            regform.email.data = email
-            regform.edition.data = edition
-            return render_template('venueregnew.html', edition=edition, regform=regform)
+                ids, kind = participant_lookup.search(edition, email, limit=5)
+                if kind == 'exact':
+                    p = Participant.query.filter_by(id=ids[0], edition=edition).first()
+                    if p is not None:
+                        return venue_confirm(edition, p)
+                    # The index was out of date; ask for a new registration
+                elif ids:
+                    # Probably a typo. Offer the closest registrations
+                    found = {p.id: p for p in Participant.query.filter(
+                        Participant.edition == edition, Participant.id.in_(ids))}
+                    return render_template('venueregsuggest.html', edition=edition, email=email,
+                                           participants=[found[id] for id in ids if id in found],
+                                           hideemail=hideemail)
+            return venue_newreg(edition, email)
+        elif formid == 'venueregpick':
+            p = Participant.query.get(request.form.get('id', type=int))
+            if p is None or p.edition != edition:
+                return venue_newreg(edition, request.form.get('email'))
+            return venue_confirm(edition, p)
+        elif formid == 'venueregnew':
+            return venue_newreg(edition, request.form.get('email'))
         elif formid == 'venueregconfirm':
             id = request.form['id']
             subscribe = request.form.get('subscribe')
@@ -762,9 +2113,9 @@ def admin_venue(edition):
                 p.subscribe = True
             else:
                 p.subscribe = False
-            p.attended = True
-            p.attenddate = datetime.utcnow()
+            mark_attended(p)
             db.session.commit()
+            notify_attendance()
             flash("You have been signed in. Next person please.", 'info')
             return redirect(url_for('admin_venue', edition=edition), code=303)
         elif formid == 'venueregform':
@@ -778,10 +2129,10 @@ def admin_venue(edition):
                 # Do not record participant.useragent since it's a venue computer, not user's.
                 makeuser(participant)
                 db.session.add(participant)
-                if MailChimp is not None and app.config['MAILCHIMP_API_KEY'] and app.config['MAILCHIMP_LIST_ID']:
-                    mc = MailChimp(app.config['MAILCHIMP_API_KEY'])
-                    addmailchimp(mc, participant)
+                db.session.flush()  # Get an id for the job
+                enqueue('mailchimp.subscribe', participant_ids=[participant.id])
                 db.session.commit()
+                participant_lookup.add(participant)
                 return render_template('venueregsuccess.html', edition=edition, p=participant)
             else:
                 return render_template('venueregform.html', edition=edition,
@@ -791,90 +2142,1283 @@ def admin_venue(edition):
             return redirect(url_for('admin_venue', edition=edition), code=303)
 
 
+def venue_confirm(edition, p):
+    """
+    Ask a participant found at the venue desk to confirm their details.
+    """
+    if p.attended:  # Already signed in
+        flash("You have already signed in. Next person please.")
+        return redirect(url_for('admin_venue', edition=edition), code=303)
+    else:
+        return render_template('venueregdetails.html', edition=edition, p=p)
+
+
+def venue_newreg(edition, email):
+    """
+    Unknown email address. Ask for new registration.
+    """
+    regform = RegisterForm()
+    regform.email.data = email
+    regform.edition.data = edition
+    return render_template('venueregnew.html', edition=edition, regform=regform)
+
+
+@app.route('/admin/venue/<edition>/lookup', methods=['GET', 'POST'])
+@adminkey('ACCESSKEY_APPROVE')
+def admin_venue_lookup(edition):
+    """
+    Search participants by email, name prefix or a near match, as JSON.
+    """
+    ids, kind = participant_lookup.search(edition, request.values.get('q', ''),
+                                          limit=max(1, min(request.values.get('limit', 10, type=int), 50)))
+    found = {p.id: p for p in Participant.query.filter(Participant.id.in_(ids))} if ids else {}
+    return jsonify(match=kind, participants=[{
+        'id': p.id,
+        'fullname': p.fullname,
+        'email': hideemail.sub('...@', p.email),
+        'company': p.company,
+        'attended': p.attended,
+        } for p in (found[id] for id in ids if id in found)])
+
+
+@app.route('/admin/venue/<edition>/offline', methods=['GET', 'POST'])
+@adminkey('ACCESSKEY_APPROVE')
+def admin_venue_offline(edition):
+    """
+    Check-in desk that works from a snapshot of the participant list and
+    queues check-ins in the browser until they can be synced.
+    """
+    return render_template('venueoffline.html', edition=edition)
+
+
+@app.route('/admin/venue/<edition>/snapshot', methods=['GET', 'POST'])
+@adminkey('ACCESSKEY_APPROVE')
+def admin_venue_snapshot(edition):
+    """
+    Compact participant list for offline check-in, as JSON. Rows are lists
+    in the order given by ``fields`` to keep the download small.
+    """
+    version = attendance_version(edition)
+    rows = [[id, fullname, hideemail.sub('...@', email), attended]
+            for id, fullname, email, attended in db.session.query(
+                Participant.id, Participant.fullname, Participant.email, Participant.attended).filter(
+                Participant.edition == edition).order_by(Participant.fullname, Participant.id).yield_per(1000)]
+    return jsonify(version=version, fields=['id', 'fullname', 'email', 'attended'], rows=rows)
+
+
+@app.route('/admin/venue/<edition>/sync', methods=['POST'])
+@adminkey('ACCESSKEY_APPROVE')
+def admin_venue_sync(edition):
+    """
+    Apply check-ins recorded offline, in one transaction. The request body
+    is JSON: ``{"checkins": [{"id": 1, "attenddate": "2010-11-27T09:30:00Z",
+    "subscribe": true}, ...]}``. Replaying check-ins is harmless: attendance
+    is never undone, the earliest ``attenddate`` wins and ``subscribe`` is
+    only ever turned on.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('checkins'), list):
+        abort(400)
+    checkins = {}
+    now = datetime.utcnow()
+    for checkin in data['checkins']:
+        if not isinstance(checkin, dict) or not isinstance(checkin.get('id'), int):
+            abort(400)
+        attenddate = parse_checkin_date(checkin.get('attenddate'), now)
+        # Merge repeats of the same participant within the batch
+        previous = checkins.get(checkin['id'])
+        if previous is not None:
+            attenddate = min(attenddate, previous[0])
+        checkins[checkin['id']] = (attenddate, bool(checkin.get('subscribe')) or bool(previous and previous[1]))
+
+    statuses = dict.fromkeys(checkins, "No such participant")
+    signedin = []
+    for chunk in chunked(list(checkins), 500):
+        for p in Participant.query.filter(Participant.edition == edition, Participant.id.in_(chunk)):
+            attenddate, subscribe = checkins[p.id]
+            if subscribe:
+                p.subscribe = True
+            if p.attended:
+                if p.attenddate is None or attenddate < p.attenddate:
+                    p.attenddate = attenddate
+                statuses[p.id] = "Already signed in"
+            else:
+                mark_attended(p, attenddate)
+                signedin.append(p)
+                statuses[p.id] = "Signed in"
+    makeusers(signedin)
+    db.session.commit()
+    notify_attendance()
+    return jsonify(statuses={str(id): status for id, status in statuses.items()},
+                   version=attendance_version(edition))
+
+
+def parse_checkin_date(value, now):
+    """
+    Parse a check-in time sent by an offline desk as a naive UTC datetime.
+    Missing, invalid or future times become ``now``.
+    """
+    try:
+        attenddate = datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    except (TypeError, ValueError):
+        return now
+    return min(attenddate, now)
+
+
 @app.route('/admin/venuesheet/<edition>', methods=['GET', 'POST'])
 @adminkey('ACCESSKEY_APPROVE')
 def admin_venuesheet(edition):
+    """
+    Sign-in sheet for the venue desks. Participants are listed a page at a
+    time, optionally filtered by a name prefix (``q``). Signing in takes one
+    or more ``id`` values so a desk can send several sign-ins at once.
+    """
     if request.method == 'GET':
-        tz = timezone(app.config['TIMEZONE'])
-        return render_template('venuesheet.html', participants=Participant.query.order_by('fullname').filter_by(edition=edition),
-                               utc=utc, tz=tz, enumerate=enumerate, hideemail=hideemail, edition=edition)
-    elif request.method == 'POST' and 'id' in request.form:
-        # Register this participant id
-        id = request.form['id']
-        p = Participant.query.get(id)
-        if not p.attended:
-            p.attended = True
-            p.attenddate = datetime.utcnow()
-            # XXX: makeuser does not add to MailChimp, to move folks along faster.
-            # MailChimp must be manually updated later.
-            makeuser(p)
-            db.session.commit()
-            return 'Signed in'
+        size = max(1, min(request.args.get('size', 50, type=int), 500))
+        prefix = request.args.get('q', '').strip()
+        page, lastid = participant_page(edition, sort='name', after=request.args.get('after', type=int),
+                                        size=size, prefix=prefix, columns=VENUESHEET_COLUMNS)
+        if lastid is not None:
+            nexturl = url_for('admin_venuesheet', edition=edition, after=lastid, size=size, q=prefix or None)
+        else:
+            nexturl = None
+        formatdate = localtime_formatter(timezone(app.config['TIMEZONE']), '%Y-%m-%d %H:%M')
+        rows = [{
+            'id': p.id,
+            'regdate': formatdate(p.regdate),
+            'fullname': p.fullname,
+            'email': hideemail.sub('...@', p.email),
+            'company': p.company,
+            'jobtitle': p.jobtitle,
+            'attended': p.attended,
+            } for p in page]
+        if request.args.get('format') == 'json':
+            return jsonify(rows=rows, next=nexturl)
+        elif request_is_xhr():
+            return render_template('venuesheet_rows.html', rows=rows, nexturl=nexturl)
         else:
-            return 'Already signed in'
+            return render_template('venuesheet.html', rows=rows, nexturl=nexturl, edition=edition,
+                                   search=prefix, version=attendance_version(edition))
+    elif request.method == 'POST' and 'id' in request.form:
+        # Register these participant ids
+        ids = [int(id) for id in request.form.getlist('id') if id.isdigit()]
+        statuses = dict.fromkeys(ids, "No such participant")
+        signedin = []
+        for chunk in chunked(ids, 500):
+            for p in Participant.query.filter(Participant.edition == edition, Participant.id.in_(chunk)):
+                if p.attended:
+                    statuses[p.id] = "Already signed in"
+                else:
+                    mark_attended(p)
+                    signedin.append(p)
+                    statuses[p.id] = "Signed in"
+        # XXX: makeusers does not add to MailChimp, to move folks along faster.
+        # MailChimp must be manually updated later.
+        makeusers(signedin)
+        db.session.commit()
+        notify_attendance()
+        return jsonify(statuses={str(id): status for id, status in statuses.items()},
+                       version=attendance_version(edition))
     else:
         return 'Unknown form submission'
 
 
+#: Columns read by the sign-in sheet
+VENUESHEET_COLUMNS = ['regdate', 'fullname', 'email', 'company', 'jobtitle', 'attended']
+
+
+@app.route('/admin/venuesheet/<edition>/changes', methods=['GET', 'POST'])
+@adminkey('ACCESSKEY_APPROVE')
+def admin_venuesheet_changes(edition):
+    """
+    Attendance changes since version ``since``, as JSON. If there are none
+    yet, wait up to ``VENUESHEET_POLL_TIMEOUT`` seconds for one (long poll).
+    Each web process holds at most ``VENUESHEET_LONG_POLLS`` such requests
+    open; beyond that, the sheet is answered at once and told to come back
+    in ``retry`` seconds.
+    """
+    since = request.args.get('since', 0, type=int)
+    longpoll = venuesheet_long_polls.acquire(False)
+    try:
+        deadline = time.time() + (app.config.get('VENUESHEET_POLL_TIMEOUT', 25) if longpoll else 0)
+        while True:
+            changes = attendance_changes(edition, since).all()
+            remaining = deadline - time.time()
+            if changes or remaining <= 0:
+                break
+            # End the transaction so the next poll sees commits from other processes
+            db.session.rollback()
+            with attendance_changed:
+                # Sign-ins in this process wake us at once; others are seen within a second
+                attendance_changed.wait(min(remaining, 1))
+    finally:
+        if longpoll:
+            venuesheet_long_polls.release()
+    return jsonify(version=changes[-1].id if changes else since,
+                   changes=[{'id': pid, 'attended': attended} for version, pid, attended in changes],
+                   retry=0 if longpoll else app.config.get('VENUESHEET_POLL_INTERVAL', 5))
+
+
 # ---------------------------------------------------------------------------
 # Admin helper functions
 
+def mark_attended(participant, attenddate=None):
+    """
+    Sign in a participant and log the change for other sign-in sheets.
+    """
+    lock_attendance_log()
+    participant.attended = True
+    participant.attenddate = attenddate or datetime.utcnow()
+    db.session.add(AttendanceLog(edition=participant.edition, participant_id=participant.id, attended=True))
+
+
+def lock_attendance_log():
+    """
+    Hold off other attendance log inserts until this transaction ends.
+    Sheets poll for log ids above the last one they saw, so ids must commit
+    in the order they are assigned. SQLite already allows one writer at a
+    time; PostgreSQL assigns ids at insert, so concurrent sign-ins could
+    otherwise commit out of order and a sheet would skip the earlier one.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute('LOCK TABLE attendance_log IN SHARE ROW EXCLUSIVE MODE')
+
+
+def attendance_version(edition):
+    """
+    Latest attendance change for an edition, or 0 if there are none.
+    """
+    return db.session.query(db.func.max(AttendanceLog.id)).filter(AttendanceLog.edition == edition).scalar() or 0
+
+
+def attendance_changes(edition, since, limit=1000):
+    """
+    Query for up to ``limit`` attendance changes after version ``since``, as
+    (id, participant_id, attended) in order.
+    """
+    return db.session.query(AttendanceLog.id, AttendanceLog.participant_id, AttendanceLog.attended).filter(
+        AttendanceLog.edition == edition, AttendanceLog.id > since).order_by(AttendanceLog.id).limit(limit)
+
+
+def notify_attendance():
+    """
+    Wake sign-in sheets waiting for changes in this process. Call after commit.
+    """
+    with attendance_changed:
+        attendance_changed.notify_all()
+
+
+def duplicate_clusters(edition):
+    """
+    Participants in an edition that share a normalized email address, as a
+    list of (email_key, participants) in order of email_key, oldest
+    registration first.
+    """
+    clusters = OrderedDict()
+    for p in Participant.query.filter(
+            Participant.edition == edition, Participant.email_key.in_(duplicate_keys(edition))).order_by(
+            Participant.email_key, Participant.regdate, Participant.id):
+        clusters.setdefault(p.email_key, []).append(p)
+    return list(clusters.items())
+
+
+def duplicate_keys(edition):
+    """
+    Query for the normalized email addresses shared by more than one
+    participant in an edition.
+    """
+    return db.session.query(Participant.email_key).filter(Participant.edition == edition).group_by(
+        Participant.email_key).having(db.func.count(Participant.id) > 1)
+
+
 def makeuser(participant):
     """
     Convert a participant into a user. Returns User object.
     """
-    if participant.user:
-        return participant.user
-    else:
-        user = User.query.filter_by(email=participant.email).first()
-        if user is not None:
-            participant.user = user
-        else:
-            user = User(fullname=participant.fullname, email=participant.email)
-            participant.user = user
+    return makeusers([participant])[0]
+
+
+def makeusers(participants):
+    """
+    Convert participants into users, looking up existing users with one query
+    per chunk of participants. Returns a list of User objects.
+    """
+    users = {}
+    pending = [p for p in participants if p.user is None]
+    for chunk in chunked(list({p.email for p in pending}), 500):
+        for user in User.query.filter(User.email.in_(chunk)):
+            users[user.email] = user
+    for participant in pending:
+        user = users.get(participant.email)
+        if user is None:
+            user = users[participant.email] = User(fullname=participant.fullname, email=participant.email)
             # These defaults don't get auto-added until the session is committed,
             # but we need them before, so we have to manually assign values here.
             user.privatekey = buid()
             db.session.add(user)
-    return user
+        participant.user = user
+    return [p.user for p in participants]
 
 
-def _makeusers():
+def accounts_by_email_key(edition, keys):
     """
-    Helper function to create user accounts. Meant for one-time use only.
+    Query for (email_key, id) of an edition's participants with an account
+    and one of these normalized email addresses.
     """
-    if MailChimp is not None and app.config['MAILCHIMP_API_KEY'] and app.config['MAILCHIMP_LIST_ID']:
-        mc = MailChimp(app.config['MAILCHIMP_API_KEY'])
-    else:
-        mc = None
-    for p in Participant.query.all():
+    return db.session.query(Participant.email_key, Participant.id).filter(
+        Participant.edition == edition, Participant.email_key.in_(keys),
+        Participant.user_id != None)  # NOQA
+
+
+def approve(edition, ids):
+    """
+    Approve participants in an edition, making active user accounts for them
+    and queuing their MailChimp subscription and notice of approval. Returns
+    a dictionary of id: status.
+    """
+    statuses = dict.fromkeys(ids, "No such user")
+    participants = []
+    for chunk in chunked(ids, 500):
+        participants.extend(Participant.query.filter(
+            Participant.edition == edition, Participant.id.in_(chunk)))
+    pending = []
+    for p in participants:
         if p.approved:
-            # Make user, but don't make account active
-            makeuser(p)
-            if mc is not None:
-                addmailchimp(mc, p)
+            statuses[p.id] = "Already approved"
+        else:
+            pending.append(p)
+
+    # Check for dupe participants (same normalized email, same edition) that
+    # already have an account, and for dupes within this batch
+    pending_ids = {p.id for p in pending}
+    taken = set()
+    for chunk in chunked(list({p.email_key for p in pending}), 500):
+        taken.update(key for key, pid in accounts_by_email_key(edition, chunk) if pid not in pending_ids)
+    approved = []
+    for p in pending:
+        if p.email_key in taken:
+            statuses[p.id] = "Dupe"
+        else:
+            taken.add(p.email_key)
+            approved.append(p)
+            p.approved = True
+            statuses[p.id] = "Tada!"
+
+    for user in makeusers(approved):
+        user.active = True
+        if user.id is not None:
+            user_cache.delete(user.id)
+    db.session.flush()  # Insert new users and link them to their participants
+    if approved:
+        approved_ids = [p.id for p in approved]
+        enqueue('mailchimp.subscribe', participant_ids=approved_ids)
+        enqueue('notice.approval', participant_ids=approved_ids)
+    return statuses
+
+
+def provision_users(rows):
+    """
+    Link participants to user accounts, creating the missing accounts with
+    one bulk insert. ``rows`` is a list of (participant id, fullname, email).
+    New accounts are not active. Returns the number of accounts created.
+    """
+    users = {}
+    emails = list({email for pid, fullname, email in rows})
+    for chunk in chunked(emails, 500):
+        users.update(db.session.query(User.email, User.id).filter(User.email.in_(chunk)))
+    new = OrderedDict()
+    for pid, fullname, email in rows:
+        if email not in users and email not in new:
+            new[email] = {'fullname': fullname, 'email': email, 'privatekey': buid(), 'active': False}
+    if new:
+        db.session.bulk_insert_mappings(User, list(new.values()))
+        for chunk in chunked(list(new), 500):
+            users.update(db.session.query(User.email, User.id).filter(User.email.in_(chunk)))
+    db.session.bulk_update_mappings(Participant, [{'id': pid, 'user_id': users[email]}
+                                                  for pid, fullname, email in rows])
+    return len(new)
+
+
+def mailchimp():
+    """
+    Return a MailChimp API client, or None if MailChimp is not configured.
+    The client class may be replaced with the MAILCHIMP_CLIENT setting, such
+    as with ``fakemailchimp.FakeMailChimp`` for testing.
+    """
+    if app.config.get('MAILCHIMP_CLIENT'):
+        client = import_string(app.config['MAILCHIMP_CLIENT'])
+    else:
+        client = MailChimp
+    if client is not None and app.config['MAILCHIMP_API_KEY'] and app.config['MAILCHIMP_LIST_ID']:
+        return client(app.config['MAILCHIMP_API_KEY'])
+
+
+class MailChimpSyncError(Exception):
+    pass
+
+
+def mailchimp_members(emails=None):
+    """
+    Merge vars for everyone who should be on the MailChimp list, by email:
+    approved participants with user accounts, limited to ``emails`` if
+    given. The latest registration's details are used, with the editions of
+    all of the user's registrations.
+    """
+    query = Participant.query.options(db.joinedload(Participant.user)).filter(
+        Participant.approved == True, Participant.user_id != None)  # NOQA
+    participants = {}
+    if emails is None:
+        for p in query.order_by(Participant.id).yield_per(1000):
+            participants[p.email] = p
+    else:
+        for chunk in chunked(list(emails), 500):
+            for p in query.filter(Participant.email.in_(chunk)).order_by(Participant.id):
+                participants[p.email] = p
+    editions = defaultdict(list)
+    for chunk in chunked(list({p.user_id for p in participants.values()}), 500):
+        for user_id, edition in db.session.query(Participant.user_id, Participant.edition).filter(
+                Participant.user_id.in_(chunk)).order_by(Participant.id):
+            editions[user_id].append(edition)
+    return {email: mailchimp_merge_vars(p, editions[p.user_id]) for email, p in participants.items()}
+
+
+def mailchimp_digest(merge_vars):
+    return hashlib.sha1(json.dumps(merge_vars, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def mailchimp_sync(mc, emails=None):
+    """
+    Bring the MailChimp list in line with :func:`mailchimp_members`, sending
+    only members whose merge vars changed since the last sync, or who should
+    no longer be on the list. With ``emails``, only those addresses are
+    synced, and any that should not be on the list are unsubscribed even if
+    they were never synced. Batches of MAILCHIMP_BATCH_SIZE are sent
+    MAILCHIMP_CONCURRENCY at a time, at most MAILCHIMP_RATE calls per second.
+
+    Commits the sync state, then raises :exc:`MailChimpSyncError` if any
+    batch failed entirely. Returns a dictionary of counts.
+    """
+    desired = mailchimp_members(emails)
+    state = {}
+    if emails is None:
+        for member in MailChimpMember.query.yield_per(1000):
+            state[member.email] = member
+    else:
+        for chunk in chunked(list(emails), 500):
+            for member in MailChimpMember.query.filter(MailChimpMember.email.in_(chunk)):
+                state[member.email] = member
+
+    digests = {email: mailchimp_digest(merge_vars) for email, merge_vars in desired.items()}
+    subscribe = [email for email in desired if email not in state or state[email].status != 'S' or
+                 state[email].digest != digests[email]]
+    if emails is None:
+        unsubscribe = [email for email, member in state.items() if member.status != 'U' and email not in desired]
+    else:
+        unsubscribe = [email for email in set(emails) if email not in desired and
+                       (email not in state or state[email].status != 'U')]
+
+    listid = app.config['MAILCHIMP_LIST_ID']
+    size = app.config.get('MAILCHIMP_BATCH_SIZE', 500)
+    bucket = TokenBucket(app.config.get('MAILCHIMP_RATE', 5), app.config.get('MAILCHIMP_CONCURRENCY', 2))
+
+    def send(batch):
+        """Make one batch call. Returns (status, batch, {email: error})."""
+        status, batch = batch
+        bucket.acquire()
+        try:
+            if status == 'S':
+                members = []
+                for email in batch:
+                    merge_vars = dict(desired[email])
+                    merge_vars['EMAIL'] = email
+                    members.append(merge_vars)
+                result = mc.listBatchSubscribe(id=listid, batch=members, double_optin=False,
+                                               update_existing=True)
+            else:
+                result = mc.listBatchUnsubscribe(id=listid, emails=batch, delete_member=False,
+                                                 send_goodbye=False, send_notify=False)
+        except Exception as e:
+            app.logger.exception("MailChimp batch of %d failed", len(batch))
+            return status, batch, dict.fromkeys(batch, '%s: %s' % (type(e).__name__, e))
+        # Unsubscribing someone who isn't subscribed is not an error
+        return status, batch, {error.get('email'): error.get('message') for error in result.get('errors', [])
+                               if not (status == 'U' and error.get('code') == 215)}
+
+    batches = [('S', batch) for batch in chunked(subscribe, size)] + [
+        ('U', batch) for batch in chunked(unsubscribe, size)]
+    counts = {'subscribed': 0, 'unsubscribed': 0, 'errors': 0, 'unchanged': len(desired) - len(subscribe)}
+    failed = 0
+    with ThreadPoolExecutor(app.config.get('MAILCHIMP_CONCURRENCY', 2)) as pool:
+        results = list(pool.map(send, batches))
+    now = datetime.utcnow()
+    for status, batch, errors in results:
+        if len(errors) == len(batch):
+            failed += 1
+        for email in batch:
+            member = state.get(email)
+            if member is None:
+                member = state[email] = MailChimpMember(email=email)
+                db.session.add(member)
+            if email in errors:
+                member.status = 'E'
+                member.last_error = errors[email]
+                counts['errors'] += 1
+            else:
+                member.status = status
+                member.digest = digests[email] if status == 'S' else None
+                member.last_error = None
+                counts['subscribed' if status == 'S' else 'unsubscribed'] += 1
+            member.updated_date = now
     db.session.commit()
+    if failed:
+        raise MailChimpSyncError("%d of %d MailChimp batches failed" % (failed, len(batches)))
+    return counts
 
 
-def addmailchimp(mc, p):
+def mailchimp_merge_vars(p, editions):
     """
-    Add user to mailchimp list
+    MailChimp merge vars for a participant who has a user account.
     """
-    editions = [ap.edition for ap in p.user.participants if p.user]
     groups = {'Editions': {'name': 'Editions', 'groups': ','.join(editions)}}
-    mc.listSubscribe(
-        id=app.config['MAILCHIMP_LIST_ID'],
-        email_address=p.email,
-        merge_vars={'FULLNAME': p.fullname,
-                    'JOBTITLE': p.jobtitle,
-                    'COMPANY': p.company,
-                    'TWITTER': p.twitter,
-                    'PRIVATEKEY': p.user.privatekey,
-                    'UID': p.user.buid,
-                    'GROUPINGS': groups},
-        double_optin=False,
-        update_existing=True
-        )
+    return {'FULLNAME': p.fullname,
+            'JOBTITLE': p.jobtitle,
+            'COMPANY': p.company,
+            'TWITTER': p.twitter,
+            'PRIVATEKEY': p.user.privatekey,
+            'UID': p.user.buid,
+            'GROUPINGS': groups}
+
+
+# ---------------------------------------------------------------------------
+# Background jobs
+
+#: Job kind -> handler function
+job_handlers = {}
+
+
+def jobhandler(kind):
+    """
+    Decorator that registers a function to run jobs of the given kind. The
+    function receives the job's payload as keyword arguments.
+    """
+    def decorator(f):
+        job_handlers[kind] = f
+        return f
+    return decorator
+
+
+def enqueue(kind, **payload):
+    """
+    Add a job to the session. It will run after the session is committed.
+    """
+    job = Job(kind=kind, payload=json.dumps(payload))
+    db.session.add(job)
+    return job
+
+
+def claim_jobs(limit):
+    """
+    Mark up to ``limit`` due jobs as running and return their ids. Safe to
+    call from several worker processes: a job is claimed by the first
+    process whose update succeeds.
+    """
+    now = datetime.utcnow()
+    # Jobs left running by a worker that died are tried again
+    stale = now - timedelta(seconds=app.config.get('JOB_TIMEOUT', 600))
+    Job.query.filter(Job.status == 'R', Job.updated_date < stale).update(
+        {'status': 'P', 'last_error': "Timed out"}, synchronize_session=False)
+    claimed = []
+    candidates = [jobid for (jobid,) in db.session.query(Job.id).filter(
+        Job.status == 'P', Job.run_after <= now).order_by(Job.id).limit(limit)]
+    for jobid in candidates:
+        count = Job.query.filter_by(id=jobid, status='P').update(
+            {'status': 'R', 'attempts': Job.attempts + 1, 'updated_date': now},
+            synchronize_session=False)
+        if count == 1:
+            claimed.append(jobid)
+    db.session.commit()
+    return claimed
+
+
+def run_job(jobid):
+    """
+    Run a claimed job. On failure, the job is retried with exponential backoff
+    until it has been attempted JOB_MAX_ATTEMPTS times.
+    """
+    job = Job.query.get(jobid)
+    try:
+        job_handlers[job.kind](**json.loads(job.payload))
+    except Exception as e:
+        db.session.rollback()
+        job = Job.query.get(jobid)
+        app.logger.exception("Job %s (%s) failed", job.id, job.kind)
+        job.last_error = '%s: %s' % (type(e).__name__, e)
+        if job.attempts >= app.config.get('JOB_MAX_ATTEMPTS', 5):
+            job.status = 'F'
+        else:
+            job.status = 'P'
+            job.run_after = datetime.utcnow() + timedelta(
+                seconds=app.config.get('JOB_RETRY_DELAY', 30) * 2 ** (job.attempts - 1))
+    else:
+        job.status = 'D'
+        job.last_error = None
+    job.updated_date = datetime.utcnow()
+    db.session.commit()
+
+
+def run_job_in_context(jobid):
+    with app.app_context():
+        run_job(jobid)
+
+
+@jobhandler('mailchimp.subscribe')
+def job_mailchimp_subscribe(participant_ids):
+    mc = mailchimp()
+    if mc is not None:
+        emails = set()
+        for chunk in chunked(participant_ids, 500):
+            emails.update(email for email, in db.session.query(Participant.email).filter(Participant.id.in_(chunk)))
+        mailchimp_sync(mc, emails)
+
+
+@jobhandler('mailchimp.unsubscribe')
+def job_mailchimp_unsubscribe(email):
+    mc = mailchimp()
+    if mc is not None:
+        mailchimp_sync(mc, [email])
+
+
+@jobhandler('notice.approval')
+def job_approval_notice(participant_ids):
+    """
+    Send notices of approval over a single SMTP connection. If the connection
+    fails partway, the participants not yet mailed are queued as a new job so
+    that a retry doesn't mail anyone twice.
+    """
+    sent = 0
+    try:
+        with mail.connect() as conn:
+            for participant_id in participant_ids:
+                p = Participant.query.get(participant_id)
+                # Skip if approval was undone before the notice went out
+                if p is not None and p.approved:
+                    try:
+                        conn.send(approval_notice(p))
+                    except smtplib.SMTPRecipientsRefused:
+                        app.logger.warning("Mail server refused %s", p.email)
+                sent += 1
+    except Exception:
+        if sent == 0:
+            raise
+        app.logger.exception("Sending approval notices failed after %d of %d", sent, len(participant_ids))
+        db.session.rollback()
+        job = enqueue('notice.approval', participant_ids=participant_ids[sent:])
+        job.run_after = datetime.utcnow() + timedelta(seconds=app.config.get('JOB_RETRY_DELAY', 30))
+        db.session.commit()
+
+
+def approval_notice(p):
+    """
+    Make the notice of approval email for a participant.
+    """
+    notice = approval_notices.get(p.edition)
+    msg = Message(subject="Your registration has been approved",
+                  recipients=[p.email])
+    msg.body, msg.html = notice.render(p)
+    msg.attach("doctypehtml5.ics", "text/calendar", notice.ics)
+    return msg
+
+
+class NoticeSkeleton(object):
+    """
+    An edition's notice of approval, rendered and converted from Markdown to
+    HTML once. Participant attributes used in the template are left as slots
+    that :meth:`render` fills in for each recipient.
+
+    Templates may only use participant attributes as plain substitutions
+    (``{{ p.fullname }}``), since filters would apply to the slot marker
+    rather than the participant's data.
+    """
+    marker = '\x1a'
+
+    class Slots(object):
+        """Stands in for the participant, marking where attributes go."""
+        def __getattr__(self, name):
+            return Markup(NoticeSkeleton.marker + name + NoticeSkeleton.marker)
+
+    def __init__(self, edition):
+        self.edition = edition
+        self.template = 'approve_notice_%s.md' % edition
+        self.icsfile = 'static/doctypehtml5-%s.ics' % edition
+        source, filename, self._uptodate = app.jinja_loader.get_source(app.jinja_env, self.template)
+        self._icsmtime = os.path.getmtime(os.path.join(app.root_path, self.icsfile))
+        with app.open_resource(self.icsfile) as ics:
+            self.ics = ics.read()
+        body = render_template(self.template, p=self.Slots())
+        self.text = body.split(self.marker)
+        self.html = markdown(body).split(self.marker)
+
+    def uptodate(self):
+        """
+        True if neither the template nor the calendar file have changed.
+        """
+        return self._uptodate() and self._icsmtime == os.path.getmtime(
+            os.path.join(app.root_path, self.icsfile))
+
+    def render(self, p):
+        """
+        Return the plain text and HTML notice for a participant.
+        """
+        text = []
+        html = []
+        # Split parts alternate between literal text and attribute names
+        for i, part in enumerate(self.text):
+            text.append(part if i % 2 == 0 else '%s' % getattr(p, part))
+        for i, part in enumerate(self.html):
+            html.append(part if i % 2 == 0 else escape(getattr(p, part)))
+        return ''.join(text), ''.join(html)
+
+
+class NoticeCache(object):
+    """
+    Notice skeletons by edition, rebuilt when their files change.
+    """
+    def __init__(self):
+        self._notices = {}
+
+    def get(self, edition):
+        notice = self._notices.get(edition)
+        if notice is None or not notice.uptodate():
+            notice = self._notices[edition] = NoticeSkeleton(edition)
+        return notice
+
+
+@app.route('/admin/mailchimp', methods=['GET', 'POST'])
+@adminkey('ACCESSKEY_APPROVE')
+def admin_mailchimp():
+    """
+    MailChimp sync status: members by status, and the latest errors.
+    """
+    return jsonify(
+        status=dict(db.session.query(MailChimpMember.status, db.func.count(MailChimpMember.id)).group_by(
+            MailChimpMember.status)),
+        errors=[{'email': m.email, 'error': m.last_error, 'date': m.updated_date.isoformat()}
+                for m in MailChimpMember.query.filter_by(status='E').order_by(
+                    MailChimpMember.updated_date.desc()).limit(50)])
+
+
+@app.route('/admin/jobs', methods=['GET', 'POST'])
+@adminkey('ACCESSKEY_APPROVE')
+def admin_jobs():
+    """
+    Job counts by kind and status, as JSON.
+    """
+    counts = defaultdict(dict)
+    for kind, status, count in db.session.query(Job.kind, Job.status, db.func.count(Job.id)).group_by(
+            Job.kind, Job.status):
+        counts[kind][status] = count
+    return jsonify(counts)
+
+
+@app.route('/admin/jobs/<int:jobid>', methods=['GET', 'POST'])
+@adminkey('ACCESSKEY_APPROVE')
+def admin_job(jobid):
+    """
+    Status of a single job, as JSON.
+    """
+    job = Job.query.get_or_404(jobid)
+    return jsonify(id=job.id, kind=job.kind, status=job.status, attempts=job.attempts,
+                   run_after=job.run_after.isoformat() + 'Z', last_error=job.last_error)
+
+
+# ---------------------------------------------------------------------------
+# Registration spool
+
+class SpoolFull(Exception):
+    pass
+
+
+class RegistrationSpool(object):
+    """
+    Write-behind buffer for registrations. Each process appends validated
+    registrations to its own file in ``directory``, one JSON object per line,
+    syncing each to disk before the visitor is told they have registered. A
+    writer thread inserts them into the database in one transaction per
+    ``batch`` registrations or every ``interval`` seconds, then empties the
+    file.
+
+    Each process holds an exclusive lock on its file, which is named with
+    the pid and a random id so that a new process never reuses the file of
+    a dead one. Files whose lock can be taken belong to processes that died,
+    and are replayed. Registrations already in the database, going by
+    edition, normalized email and registration time, are skipped: these were
+    written before a crash but not yet removed from the file. Repeat
+    submissions have their own registration time and are kept.
+
+    If the database rejects a batch, its rows are inserted one at a time,
+    and those it still rejects are moved to ``rejected.log`` in the spool
+    directory so they don't hold up the rest.
+    """
+    def __init__(self, directory, batch=100, interval=0.2, maxsize=10000):
+        self.directory = directory
+        self.batch = batch
+        self.interval = interval
+        self.maxsize = maxsize
+        self.counters = defaultdict(int)
+        self._pid = None
+        self._lock = Lock()
+        self._flushing = Lock()
+
+    def _start(self):
+        """
+        Open this process's spool file and start the writer. Called on first
+        use, and again after a fork.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._pid = os.getpid()
+        self._path = os.path.join(self.directory, '%d-%s.jsonl' % (self._pid, buid()))
+        self._file = open(self._path, 'ab+')
+        fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._offset = 0
+        self._pending = 0
+        self._wakeup = Event()
+        thread = Thread(target=self._run, name='registration-spool')
+        thread.daemon = True
+        thread.start()
+
+    def append(self, record):
+        """
+        Durably queue a registration, a dictionary of Participant columns.
+        Raises :exc:`SpoolFull` if the writer has fallen too far behind.
+        """
+        line = json.dumps(record).encode('utf-8') + b'\n'
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+            if self._pending >= self.maxsize:
+                self.counters['full'] += 1
+                raise SpoolFull()
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending += 1
+            self.counters['queued'] += 1
+            if self._pending >= self.batch:
+                self._wakeup.set()
+
+    def _run(self):
+        with app.app_context():
+            self.recover()
+            while True:
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+                try:
+                    self.flush()
+                except Exception:
+                    db.session.rollback()
+                    self.counters['errors'] += 1
+                    app.logger.exception("Could not write spooled registrations")
+                    time.sleep(1)
+
+    def flush(self):
+        """
+        Commit queued registrations. New registrations may be appended while
+        this runs; they are left for the next flush.
+        """
+        with self._flushing:
+            with self._lock:
+                if self._pid != os.getpid() or not self._pending:
+                    return
+                self._file.seek(self._offset)
+                data = self._file.read()
+                count = self._pending
+            self.counters['written'] += self.replay(data)
+            self.counters['commits'] += 1
+            with self._lock:
+                self._offset += len(data)
+                self._pending -= count
+                if not self._pending:
+                    # If we die before this reaches the disk, replay skips what was committed
+                    self._file.truncate(0)
+                    self._offset = 0
+
+    def close(self):
+        """
+        Commit queued registrations before the process exits, and remove the
+        spool file if they were all written.
+        """
+        with app.app_context():
+            self.flush()
+        with self._lock:
+            if self._pid == os.getpid() and not self._pending:
+                self._file.close()
+                os.remove(self._path)
+                self._pid = None
+
+    def recover(self):
+        """
+        Replay spool files left behind by processes that died. Returns the
+        number of registrations written.
+        """
+        written = 0
+        for path in glob.glob(os.path.join(self.directory, '*.jsonl')):
+            try:
+                spoolfile = open(path, 'rb')
+            except (IOError, OSError):
+                continue  # Replayed by another process
+            with spoolfile:
+                try:
+                    fcntl.flock(spoolfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    continue  # Still in use
+                written += self.replay(spoolfile.read())
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass  # Replayed and removed by another process
+        self.counters['recovered'] += written
+        return written
+
+    def replay(self, data):
+        """
+        Insert the registrations in spooled ``data`` in one transaction,
+        skipping any that were already inserted. Returns the number inserted.
+        """
+        records = []
+        for line in data.splitlines():
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue  # Partly written when the process died
+            try:
+                record['regdate'] = datetime.strptime(record['regdate'], '%Y-%m-%dT%H:%M:%S.%f')
+                if not (record.get('edition') and record.get('email_key')):
+                    raise ValueError("No edition or email address")
+            except (KeyError, TypeError, ValueError) as e:
+                self.reject(line, e)
+                continue
+            records.append((line, record))
+        committed = set()
+        editions = list({record['edition'] for line, record in records})
+        for chunk in chunked(list({record['email_key'] for line, record in records}), 500):
+            committed.update(db.session.query(Participant.edition, Participant.email_key, Participant.regdate).filter(
+                Participant.edition.in_(editions), Participant.email_key.in_(chunk)))
+        rows = []
+        for line, record in records:
+            key = (record['edition'], record['email_key'], record['regdate'])
+            if key not in committed:
+                committed.add(key)
+                if record.get('useragent'):
+                    record['ua_browser'], record['ua_version'], record['ua_platform'] = uaclassifier.classify(
+                        record['useragent'])
+                rows.append((line, record))
+        try:
+            db.session.bulk_insert_mappings(Participant, [record for line, record in rows])
+            db.session.commit()
+        except (DataError, IntegrityError):
+            db.session.rollback()
+        else:
+            return len(rows)
+        # Find the rows at fault. Other errors, such as a lost connection,
+        # are raised so that the whole batch is tried again later
+        written = 0
+        for line, record in rows:
+            try:
+                db.session.bulk_insert_mappings(Participant, [record])
+                db.session.commit()
+                written += 1
+            except (DataError, IntegrityError) as e:
+                db.session.rollback()
+                self.reject(line, e)
+        return written
+
+    def reject(self, line, error):
+        """
+        Move a spooled line the database won't accept to ``rejected.log``.
+        """
+        app.logger.error("Rejected spooled registration: %s", error)
+        with open(os.path.join(self.directory, 'rejected.log'), 'ab') as rejected:
+            rejected.write(line.rstrip(b'\n') + b'\n')
+            rejected.flush()
+            os.fsync(rejected.fileno())
+        self.counters['rejected'] += 1
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['pending'] = self._pending if self._pid == os.getpid() else 0
+        return stats
+
+
+# ---------------------------------------------------------------------------
+# Command line
+
+@app.cli.command('worker')
+@click.option('--threads', default=4, help="Jobs to run at once")
+@click.option('--poll', default=2.0, help="Seconds to wait when there are no jobs")
+@click.option('--once', is_flag=True, help="Exit when there are no more jobs due")
+def worker(threads, poll, once):
+    """Run background jobs."""
+    running = set()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            # Claim only as many jobs as there are idle threads, so a slow job
+            # holds up its own thread and not the rest of the queue
+            if len(running) < threads:
+                for jobid in claim_jobs(threads - len(running)):
+                    running.add(pool.submit(run_job_in_context, jobid))
+            if running:
+                done, running = wait(running, timeout=poll, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is not None:
+                        app.logger.error("Worker thread failed", exc_info=future.exception())
+            elif once:
+                break
+            else:
+                time.sleep(poll)
+
+
+def admin_queries(edition):
+    """
+    The queries that the admin and RSVP routes run, as (route, query) pairs,
+    built by the same functions the routes use. Used by the ``checkplans``
+    command to confirm they are indexed.
+    """
+    return [
+        ('admin_list', participant_page_query(edition, sort='name', columns=LIST_COLUMNS)),
+        ('admin_reasons', participant_page_query(edition, sort='regdate', columns=REASONS_COLUMNS)),
+        ('admin_data', participant_page_query(edition, sort='regdate', columns=PARTICIPANT_DATA_COLUMNS)),
+        ('admin_data export', participant_data_query(edition)),
+        ('admin_rsvp', edition_counter_query(edition)),
+        ('admin_stats', useragent_query(edition)),
+        ('admin_approve', approval_queue(edition)),
+        ('approve', accounts_by_email_key(edition, ['test@example.com'])),
+        ('admin_duplicates', duplicate_keys(edition)),
+        ('admin_venue', participant_lookup.query(edition, 0)),
+        ('admin_venuesheet', participant_page_query(edition, sort='name', prefix='A', columns=VENUESHEET_COLUMNS)),
+        ('admin_venuesheet_changes', attendance_changes(edition, 0)),
+        ('rsvp', Participant.query.filter_by(user_id=1, edition=edition)),
+        ]
+
+
+def query_plan(query):
+    """
+    Return the database's query plan for a query as a list of strings.
+    Only SQLite and PostgreSQL are supported.
+    """
+    dialect = db.engine.dialect
+    sql = str(query.statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+    if dialect.name == 'sqlite':
+        return [row[-1] for row in db.session.execute('EXPLAIN QUERY PLAN ' + sql)]
+    elif dialect.name == 'postgresql':
+        # Small development tables are cheaper to scan than to search, so
+        # make the planner prefer an index wherever one is usable
+        db.session.execute('SET LOCAL enable_seqscan = off')
+        return [row[0] for row in db.session.execute('EXPLAIN ' + sql)]
+    else:
+        raise ValueError("Query plans are not supported on %s" % dialect.name)
+
+
+fullscan = re.compile(r'^\s*(SCAN (TABLE )?participant\b|.*Seq Scan on participant\b)')
+
+
+@app.cli.command('buildassets')
+def buildassets():
+    """Build minified, content-hashed static asset bundles."""
+    for module, name in ((rcssmin, 'rcssmin'), (rjsmin, 'rjsmin')):
+        if module is None:
+            click.echo("%s is not installed; its files will not be minified" % name, err=True)
+    manifest = {}
+    for bundle in sorted(ASSET_BUNDLES):
+        manifest[bundle] = build_bundle(bundle)
+        click.echo("%s -> %s" % (bundle, manifest[bundle]))
+    with open(os.path.join(app.static_folder, 'assets.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+@app.cli.command('buildimages')
+def buildimages():
+    """Make optimized, resized and WebP copies of images under static/img."""
+    if Image is None:
+        raise click.ClickException("Pillow is required to build images")
+    manifest = {}
+    imgfolder = os.path.join(app.static_folder, 'img')
+    for root, dirs, files in os.walk(imgfolder):
+        if os.path.relpath(root, imgfolder).split(os.sep)[0] == 'opt':
+            continue  # Our own output
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in ('.png', '.jpg', '.jpeg'):
+                filename = os.path.relpath(os.path.join(root, name), app.static_folder).replace(os.sep, '/')
+                entry = manifest[filename] = build_image_variants(filename)
+                click.echo("%s: %d variants" % (filename, len(entry['original']) + len(entry['webp'])))
+    with open(os.path.join(imgfolder, 'opt', 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+@app.cli.command('compressstatic')
+def compressstatic():
+    """Write precompressed copies of compressible static files."""
+    for root, dirs, files in os.walk(app.static_folder):
+        for name in sorted(files):
+            if os.path.splitext(name)[1] in COMPRESSIBLE_STATIC:
+                path = os.path.join(root, name)
+                written = compress_static(path)
+                if written:
+                    click.echo("%s: %s" % (os.path.relpath(path, app.static_folder), ', '.join(written)))
+
+
+@app.cli.command('backfilluseragents')
+@click.option('--chunk', default=1000, help="Rows per transaction")
+def backfilluseragents(chunk):
+    """Parse stored user agents into browser and platform columns."""
+    lastid = 0
+    total = 0
+    while True:
+        rows = db.session.query(Participant.id, Participant.useragent).filter(
+            Participant.id > lastid, Participant.useragent != None,  # NOQA
+            Participant.ua_browser == None).order_by(Participant.id).limit(chunk).all()  # NOQA
+        if not rows:
+            break
+        updates = []
+        for pid, useragent in rows:
+            browser, version, platform = uaclassifier.classify(useragent)
+            updates.append({'id': pid, 'ua_browser': browser, 'ua_version': version, 'ua_platform': platform})
+        db.session.bulk_update_mappings(Participant, updates)
+        db.session.commit()
+        lastid = rows[-1][0]
+        total += len(rows)
+        click.echo("Parsed %d user agents" % total)
+
+
+@app.cli.command('makeusers')
+@click.option('--edition', default=None, help="Only this edition")
+@click.option('--chunk', default=500, help="Participants per transaction")
+@click.option('--after', default=0, help="Resume after this participant id")
+@click.option('--mailchimp/--no-mailchimp', 'subscribe', default=False,
+              help="Queue MailChimp subscriptions for each chunk")
+def makeusers_command(edition, chunk, after, subscribe):
+    """Make user accounts for approved participants who don't have one."""
+    # Each chunk is committed, and only participants without an account are
+    # picked up, so running this again resumes where a failed run stopped
+    lastid = after
+    total = created = 0
+    while True:
+        query = db.session.query(Participant.id, Participant.fullname, Participant.email).filter(
+            Participant.id > lastid, Participant.approved == True,  # NOQA
+            Participant.user_id == None)  # NOQA
+        if edition:
+            query = query.filter(Participant.edition == edition)
+        rows = query.order_by(Participant.id).limit(chunk).all()
+        if not rows:
+            break
+        created += provision_users(rows)
+        if subscribe:
+            enqueue('mailchimp.subscribe', participant_ids=[row[0] for row in rows])
+        db.session.commit()
+        lastid = rows[-1][0]
+        total += len(rows)
+        click.echo("Linked %d participants, made %d users (last id %d)" % (total, created, lastid))
+
+
+@app.cli.command('syncmailchimp')
+def syncmailchimp():
+    """Send changed list members to MailChimp."""
+    mc = mailchimp()
+    if mc is None:
+        raise click.ClickException("MailChimp is not configured")
+    try:
+        counts = mailchimp_sync(mc)
+    except MailChimpSyncError as e:
+        raise click.ClickException(str(e))
+    click.echo("Subscribed %(subscribed)d, unsubscribed %(unsubscribed)d, "
+               "%(unchanged)d unchanged, %(errors)d errors" % counts)
+
+
+@app.cli.command('replayspool')
+@click.argument('directory', required=False)
+def replayspool(directory):
+    """Write registrations left in the spool by stopped processes."""
+    directory = directory or app.config.get('REGISTRATION_SPOOL')
+    if not directory:
+        raise click.ClickException("No spool directory given and REGISTRATION_SPOOL is not set")
+    click.echo("Wrote %d registrations" % RegistrationSpool(directory).recover())
+
+
+@app.cli.command('benchpasswords')
+@click.option('--target', default=0.1, help="Seconds one hash should take")
+def benchpasswords(target):
+    """Find the PBKDF2 iterations that take about --target seconds."""
+    iterations = 10000
+    elapsed = benchmark_password_hash(iterations)
+    while elapsed < target:
+        iterations = int(iterations * max(1.25, min(target / max(elapsed, 0.001), 4)))
+        elapsed = benchmark_password_hash(iterations)
+        click.echo("%d iterations: %.3fs" % (iterations, elapsed))
+    click.echo("PASSWORD_HASH_METHOD = 'pbkdf2:sha256:%d'" % iterations)
+    click.echo("Currently using %s" % password_hasher.prefix)
+
+
+@app.cli.command('benchqueries')
+@click.option('--rows', default=50000, help="Participants to generate")
+def benchqueries(rows):
+    """Compare loading admin views as Participants and as column tuples."""
+    import tracemalloc
+    edition = u'benchmark-%s' % buid()
+    now = datetime.utcnow()
+    for chunk in chunked(range(rows), 5000):
+        db.session.bulk_insert_mappings(Participant, [{
+            'fullname': u'Participant %d' % i, 'email': u'p%d@example.com' % i,
+            'email_key': u'p%d@example.com' % i, 'edition': edition, 'company': u'Company %d' % (i % 500),
+            'jobtitle': u'Developer', 'twitter': u'p%d' % i, 'reason': u'Reason for attending. ' * 40,
+            'useragent': u'Mozilla/5.0 (X11; Linux x86_64) Firefox/60.0', 'regdate': now, 'ipaddr': u'127.0.0.1',
+            'tshirtsize': 0, 'referrer': 0, 'category': 0, 'approved': False, 'rsvp': u'A', 'attended': False,
+            'subscribe': False} for i in chunk])
+    views = [('reasons', ['reason'], lambda p: {'reason': p.reason}),
+             ('list', ['fullname', 'company', 'jobtitle', 'twitter', 'approved', 'rsvp', 'attended'],
+              lambda p: {'name': p.fullname, 'company': p.company, 'jobtitle': p.jobtitle}),
+             ('data', PARTICIPANT_DATA_COLUMNS, participant_formatter())]
+    try:
+        for name, columns, rowformat in views:
+            for kind, query in [('objects', Participant.query), ('columns', participant_query('id', *columns))]:
+                db.session.expunge_all()
+                tracemalloc.start()
+                start = time.time()
+                count = 0
+                for p in query.filter(Participant.edition == edition).order_by(Participant.id).yield_per(1000):
+                    rowformat(p)
+                    count += 1
+                elapsed = time.time() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                click.echo("%-8s %-8s %6d rows %8.3fs %8.1f MB peak" % (name, kind, count, elapsed, peak / 1e6))
+    finally:
+        db.session.rollback()
+
+
+@app.cli.command('hashkey')
+@click.argument('key')
+def hashkey(key):
+    """Print an access key in hashed form, for settings."""
+    click.echo("sha256:" + accesskey_digest(key))
+
+
+@app.cli.command('checkplans')
+@click.option('--edition', default='bangalore', help="Edition to query for")
+def checkplans(edition):
+    """Fail if an admin route's query scans the participant table."""
+    failed = False
+    for route, query in admin_queries(edition):
+        plan = query_plan(query)
+        if any(fullscan.match(line) for line in plan):
+            failed = True
+            click.echo("%s: full table scan" % route, err=True)
+            for line in plan:
+                click.echo("    %s" % line, err=True)
+        else:
+            click.echo("%s: ok" % route)
+    db.session.rollback()
+    if failed:
+        raise SystemExit(1)
 
 
 # ---------------------------------------------------------------------------
@@ -896,6 +3440,85 @@ except ImportError:
 # Initialize mail settings
 mail.init_app(app)
 
+#: Admin access keys, reloaded when settings.py changes
+access_keys = AccessKeys(app.config, getattr(sys.modules.get('settings'), '__file__', None),
+                         ttl=app.config.get('ADMIN_SESSION_TTL', 86400))
+
+#: Rendered stats charts, per edition
+stats_cache = TTLCache(app.config.get('STATS_CACHE_TTL', 60))
+
+#: Content hashes of static files
+static_etags = StaticETags()
+
+#: Built asset bundles, if any
+asset_manifest = load_asset_manifest()
+built_assets = frozenset(asset_manifest.values())
+#: Source file URLs of bundles that haven't been built
+asset_source_urls = {}
+app.jinja_env.globals['assets'] = asset_urls
+
+#: Image variants, if any
+image_manifest = load_image_manifest()
+app.jinja_env.globals['picture'] = picture
+
+#: Rendered pages for anonymous visitors
+if app.config.get('PAGE_CACHE_BACKEND') == 'memory':
+    page_cache = MemoryPageCache(app.config.get('PAGE_CACHE_TTL', 300))
+elif app.config.get('PAGE_CACHE_BACKEND') == 'filesystem':
+    page_cache = FilesystemPageCache(app.config.get('PAGE_CACHE_TTL', 300),
+                                     app.config.get('PAGE_CACHE_DIR') or os.path.join(app.instance_path, 'pagecache'))
+else:
+    page_cache = None
+#: Hosts whose pages may be cached
+page_cache_hosts = frozenset(host.lower() for host in app.config.get('PAGE_CACHE_HOSTS') or
+                             filter(None, [app.config.get('SERVER_NAME')]))
+register_metrics('pagecache', lambda: dict(pagecache_counters))
+
+#: Logged in users, by id. Set USER_CACHE_TTL = 0 to disable
+user_cache = TTLCache(app.config.get('USER_CACHE_TTL', 30))
+
+#: Notices of approval, per edition
+approval_notices = NoticeCache()
+
+#: Participants by email and name, for the venue desk
+participant_lookup = ParticipantLookup(app.config.get('LOOKUP_REFRESH_INTERVAL', 5))
+register_metrics('lookup', participant_lookup.stats)
+
+#: Buffered registrations, if REGISTRATION_SPOOL is set
+if app.config.get('REGISTRATION_SPOOL'):
+    registration_spool = RegistrationSpool(app.config['REGISTRATION_SPOOL'],
+                                           batch=app.config.get('REGISTRATION_SPOOL_BATCH', 100),
+                                           interval=app.config.get('REGISTRATION_SPOOL_INTERVAL', 0.2))
+    register_metrics('spool', registration_spool.stats)
+    atexit.register(registration_spool.close)
+else:
+    registration_spool = None
+
+#: Password hashing, in a process pool
+password_hasher = PasswordHasher(app.config.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256'),
+                                 workers=app.config.get('PASSWORD_HASH_WORKERS', 2),
+                                 backlog=app.config.get('PASSWORD_HASH_BACKLOG', 16))
+register_metrics('passwords', password_hasher.stats)
+
+#: Rate limits on form submissions
+if app.config.get('RATE_LIMIT_BACKEND', 'memory') == 'memory':
+    rate_limiter = MemoryLimiter()
+elif app.config['RATE_LIMIT_BACKEND'] == 'sqlite':
+    rate_limiter = SQLiteLimiter(app.config.get('RATE_LIMIT_SQLITE') or os.path.join(app.instance_path, 'ratelimit.db'))
+else:
+    rate_limiter = None
+ratelimit_counters = defaultdict(int)
+register_metrics('ratelimit', lambda: dict(ratelimit_counters, errors=getattr(rate_limiter, 'errors', 0)))
+
+#: Notified when attendance changes, to wake long-polling sign-in sheets
+attendance_changed = Condition()
+#: Long-polling sign-in sheets each hold a web worker thread, so limit them
+venuesheet_long_polls = BoundedSemaphore(app.config.get('VENUESHEET_LONG_POLLS', 2))
+
+#: Parsed user agents, shared by registration and the backfill command
+uaclassifier = UAClassifier(app.config.get('USERAGENT_CACHE_SIZE', 1024))
+register_metrics('useragent', uaclassifier.stats)
+
 application = app
 
 